@@ -19,71 +19,303 @@
 
 from auth_plugin import EnterpriseAuthPlugin, main
 
+import os
 import sys
-import syslog
+import time
+import logging
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 sys.path.append("/opt/skladki")
 import skladki_lib
 
-syslog.openlog("zamek_auth_plugin", 0, 128)
+from constants import *
+from configutil import get_option
+from audit import open_audit_log
+from cache import NegativeCache, AttemptRate
+
+config_file = ConfigParser.RawConfigParser()
+config_file.read(['config.ini', 'localconfig.ini'])
+
+api_deadline = get_option(config_file, CONFIG_SECTION_SKLADKI, CONFIG_SKLADKI_DEADLINE, 3.0)
+api_workers = get_option(config_file, CONFIG_SECTION_SKLADKI, CONFIG_SKLADKI_WORKERS, 2)
+negative_ttl = get_option(config_file, CONFIG_SECTION_SKLADKI, CONFIG_SKLADKI_NEGATIVE_TTL, 30)
+
+audit = open_audit_log('zamek_auth_plugin')
+
+
+def log(txt, **fields):
+    audit.record(txt, **fields)
+
+
+class SkladkiAPIClient(object):
+    '''
+    Skladki API connection per worker thread, connected on first use and then reused.
+    '''
+    def __init__(self):
+        super(SkladkiAPIClient, self).__init__()
+        self._local = threading.local()
+
+    def get_user_by_card(self, card_number):
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = skladki_lib.SkladkiAPI()
+            api.connect()
+            self._local.api = api
+
+        try:
+            return api.getUserByCard(card_number)
+        except Exception:
+            # reconnect on next lookup
+            self._local.api = None
+            raise
+
+
+class LookupPool(object):
+    '''
+    Thread pool that runs at most workers lookups at a time and queues none.
 
+    A deadline only stops waiting for a lookup, it keeps its worker until the
+    API answers. Without the bound every swipe during an API hang would queue
+    another job, and after recovery fresh lookups would wait behind the stale ones.
+    '''
+    def __init__(self, workers):
+        super(LookupPool, self).__init__()
+        self._pool = multiprocessing.pool.ThreadPool(workers)
+        self._slots = threading.BoundedSemaphore(workers)
 
-def log(txt):
-    syslog.syslog(txt.encode("utf-8"))
-    print(txt.encode("utf-8"))
+    def _run(self, func, args):
+        try:
+            return func(*args)
+        finally:
+            self._slots.release()
 
+    def apply_async(self, func, args):
+        '''
+        Returns AsyncResult of func(*args), None right away when every worker is busy.
+        '''
+        if not self._slots.acquire(False):
+            return None
 
-def check_card_api(card_number):
-    api = skladki_lib.SkladkiAPI()
-    api.connect()
-    user = api.getUserByCard(card_number)
+        return self._pool.apply_async(self._run, (func, args))
+
+
+# what check_card found out about a card
+CARD_ACCEPTED = 'accepted'
+CARD_REJECTED = 'rejected'
+CARD_UNKNOWN = 'unknown'
+CARD_LOOKUP_FAILED = 'lookup_failed'
+
+
+def check_card_api(card_number, client):
+    user = client.get_user_by_card(card_number)
     if user is None:
         log('No card in database')
-        return False
+        return CARD_UNKNOWN
 
     if user.active:
         log(u"User {0} auth succeed".format(user.getLongName()))
-        return True
+        return CARD_ACCEPTED
     else:
         log(u"User {0} card is not active".format(user.getLongName()))
-        return False
+        return CARD_REJECTED
+
+
+class CardList(object):
+    '''
+    Local list of cards, one "number: comment" per line, lines starting with ';' are ignored.
+
+    The file is parsed once into a set and parsed again only after it has
+    changed: inotify marks it dirty when inotify_simple is installed,
+    otherwise every lookup compares the file's inode, mtime and size.
+    '''
+    def __init__(self, path):
+        super(CardList, self).__init__()
+        self._path = path
+        self._cards = frozenset()
+        self._stamp = None
+        self._dirty = True
+        self._lock = threading.Lock()
+        self._watching = False
 
+        self._watch()
+        self._reload()
 
-def check_card(card_number):
-    if check_card_api(card_number):
-        return True
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
 
-    with file('karty.txt', 'r') as f:
-        for line in f:
-            number = line.strip()
+        return stat.st_ino, stat.st_mtime, stat.st_size
 
-            if len(number) == 0:
+    def _parse(self, f):
+        cards = set()
+
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+
+            if len(line) == 0:
+                continue
+
+            if line[0] == ';':
                 continue
 
-            if number[0] == ';':
+            number, separator, comment = line.partition(':')
+            number = number.strip()
+
+            if not separator or not number.isdigit():
+                log('{0}:{1}: malformed card entry, ignoring: {2}'.format(self._path, lineno, line))
                 continue
 
-            number, comment = map(lambda x: x.strip(), number.split(':'))
+            cards.add(number)
+
+        return frozenset(cards)
 
-            if card_number == number:
-                return True
+    def _reload(self):
+        with self._lock:
+            self._dirty = False
 
-    return False
+            stamp = self._file_stamp()
+            if stamp == self._stamp:
+                return
+
+            try:
+                with open(self._path, 'r') as f:
+                    self._cards = self._parse(f)
+            except IOError as e:
+                log('Cannot read card list {0}: {1}'.format(self._path, e))
+                self._cards = frozenset()
+
+            self._stamp = stamp
+
+        logging.info('Loaded %d cards from %s', len(self._cards), self._path)
+
+    def _watch_loop(self, inotify):
+        name = os.path.basename(self._path)
+
+        while True:
+            for event in inotify.read():
+                if event.name == name:
+                    self._dirty = True
+
+    def _watch(self):
+        if inotify_simple is None:
+            return
+
+        flags = inotify_simple.flags
+        inotify = inotify_simple.INotify()
+        inotify.add_watch(os.path.dirname(os.path.abspath(self._path)),
+                          flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE | flags.MOVED_FROM)
+
+        thread = threading.Thread(target=self._watch_loop, args=(inotify,))
+        thread.daemon = True
+        thread.start()
+
+        self._watching = True
+
+    def __len__(self):
+        return len(self._cards)
+
+    def __contains__(self, card_number):
+        if self._dirty or (not self._watching and self._file_stamp() != self._stamp):
+            self._reload()
+
+        return str(card_number) in self._cards
+
+
+def check_card(card_number, card_list, client, api_pool, unknown):
+    '''
+    Returns one of CARD_ACCEPTED, CARD_REJECTED, CARD_UNKNOWN (neither the list
+    nor the API know the card) and CARD_LOOKUP_FAILED (the API did not answer).
+    '''
+    # local list is an in-memory set, it never has to wait for the API
+    if card_number in card_list:
+        return CARD_ACCEPTED
+
+    if card_number in unknown:
+        return CARD_UNKNOWN
+
+    result = api_pool.apply_async(check_card_api, (card_number, client))
+    if result is None:
+        log(u"Skladki API is busy with {0} lookups, not asking about card {1}".format(api_workers, card_number))
+
+        return CARD_LOOKUP_FAILED
+
+    try:
+        retval = result.get(api_deadline)
+        if retval == CARD_UNKNOWN:
+            unknown.add(card_number)
+
+        return retval
+    except multiprocessing.TimeoutError:
+        log(u"Skladki API did not answer within {0}s".format(api_deadline))
+    except Exception as e:
+        log(u"Skladki API lookup failed: {0}".format(e))
+
+    return CARD_LOOKUP_FAILED
 
 
 class SkladkiAPIAuthPlugin(EnterpriseAuthPlugin):
+    CARDS_FILE = 'karty.txt'
+    NEGATIVE_CACHE_SIZE = 1024
+
     def __init__(self):
         super(SkladkiAPIAuthPlugin, self).__init__()
         self.name = 'Connector for old system'
 
+        self._card_list = CardList(SkladkiAPIAuthPlugin.CARDS_FILE)
+        self._client = SkladkiAPIClient()
+        self._api_pool = LookupPool(api_workers)
+
+        # cards the API recently had no user for, and how often each zone sees such cards
+        self._unknown = NegativeCache(negative_ttl, SkladkiAPIAuthPlugin.NEGATIVE_CACHE_SIZE)
+        self._unknown_attempts = AttemptRate(60)
+        self._stats_lock = threading.Lock()
+        self._lookups_failed = 0
+
+    def stats(self):
+        with self._stats_lock:
+            lookups_failed = self._lookups_failed
+
+        return {
+            'negative_cached': len(self._unknown),
+            'unknown_per_minute': self._unknown_attempts.rates(),
+            'lookups_failed': lookups_failed,
+        }
+
     def on_cardread(self, zoneid, cardcode):
-        retval = check_card(cardcode)
+        started = time.time()
+        result = check_card(cardcode, self._card_list, self._client, self._api_pool, self._unknown)
+        retval = result == CARD_ACCEPTED
+
+        # an API outage is not someone trying cards
+        if result == CARD_UNKNOWN:
+            self._unknown_attempts.hit(zoneid)
+        elif result == CARD_LOOKUP_FAILED:
+            with self._stats_lock:
+                self._lookups_failed += 1
 
         if retval:
             self.accept(zoneid)
         else:
             self.reject(zoneid)
 
+        log(u"{0} card {1} for zone {2}".format('accepted' if retval else 'rejected', cardcode, zoneid),
+            zone=zoneid, card=cardcode, decision=ACTION_ACCEPT if retval else ACTION_REJECT,
+            latency=time.time() - started)
+
 
 if __name__ == '__main__':
     main(SkladkiAPIAuthPlugin)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+asyncio runtime for authorization plugins (Python 3 only).
+
+Plugins may define their hooks as coroutines:
+
+    class MyPlugin(EnterpriseAuthPlugin):
+        async def on_cardread(self, zoneid, cardcode):
+            user = await backend.lookup(cardcode)
+            ...
+
+Async hooks run on the event loop, so many swipes can wait for their
+backends at the same time on one thread. Plain synchronous hooks (all the
+existing plugins) keep working: they are run in a thread pool executor.
+
+Run an existing plugin on this runtime with:
+
+    python3 async_plugin.py ldapentry:LDAPAuthPlugin
+'''
+
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import contextvars
+import collections
+import concurrent.futures
+
+import paho.mqtt.client as paho
+
+from auth_plugin import AuthPluginRunner, load_plugin_class, main as runner_main
+
+# card read seen by async hooks, thread locals do not follow a coroutine across awaits
+current_read = contextvars.ContextVar('current_read', default=None)
+
+
+class AsyncZoneDispatcher(object):
+    '''
+    asyncio counterpart of ZoneDispatcher: one consumer task per busy zone,
+    at most `workers` events handled at once.
+    '''
+    def __init__(self, loop, workers, queue_depth):
+        super(AsyncZoneDispatcher, self).__init__()
+        self._loop = loop
+        self._queue_depth = queue_depth
+        self._slots = asyncio.Semaphore(workers)
+        self._queues = {}
+        self.dropped = 0
+
+    def dispatch(self, zone, job):
+        queue = self._queues.get(zone)
+
+        if queue is None:
+            queue = self._queues[zone] = collections.deque()
+            self._loop.create_task(self._consume(zone, queue))
+
+        if len(queue) >= self._queue_depth:
+            logging.warning('Event queue of zone %s is full, dropping oldest event', zone)
+
+            queue.popleft()
+            self.dropped += 1
+
+        queue.append(job)
+
+    async def _consume(self, zone, queue):
+        while queue:
+            job = queue.popleft()
+
+            async with self._slots:
+                try:
+                    result = job()
+                    if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+                        await result
+                except Exception:
+                    logging.exception('Plugin failed to handle event for zone %s', zone)
+
+        del self._queues[zone]
+
+
+class AsyncAuthPluginRunner(AuthPluginRunner):
+    '''
+    AuthPluginRunner driving paho from an asyncio event loop instead of loop_forever.
+    '''
+    RECONNECT_DELAY_MIN = 1
+    RECONNECT_DELAY_MAX = 60
+
+    def _create_dispatcher(self):
+        # created in run(), once the event loop exists
+        return None
+
+    def _deliver(self, route):
+        event, hook, handler, plugins = route
+
+        for index, plugin in plugins:
+            self._dispatcher.dispatch((index, event.zone), self._job(plugin, hook, handler, event))
+
+    def _local_incoming(self, topic, payload):
+        # the dispatcher is only safe to use on the event loop
+        self._loop.call_soon_threadsafe(super(AsyncAuthPluginRunner, self)._local_incoming, topic, payload)
+
+    def _current_read(self):
+        return super(AsyncAuthPluginRunner, self)._current_read() or current_read.get()
+
+    async def _in_read(self, plugin, handler, event):
+        current_read.set(None if event.read_id is None else
+                         {'read_id': event.read_id, 'received': event.received, 'started': time.time()})
+
+        result = handler(plugin, event)
+        if result is not None:
+            return await result
+
+    def _job(self, plugin, hook, handler, event):
+        if asyncio.iscoroutinefunction(getattr(plugin, hook)):
+            return lambda: self._in_read(plugin, handler, event)
+
+        return lambda: self._loop.run_in_executor(self._executor, lambda: handler(plugin, event))
+
+    # paho calls these from whichever thread publishes, hence call_soon_threadsafe
+    def _socket_open(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.add_reader, sock, client.loop_read)
+
+    def _socket_close(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.remove_reader, sock)
+
+    def _socket_register_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.add_writer, sock, client.loop_write)
+
+    def _socket_unregister_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.remove_writer, sock)
+
+    def _mqtt_disconnected(self, client, userdata, rc):
+        logging.warning('MQTT disconnected (%s)', rc)
+
+        super(AsyncAuthPluginRunner, self)._mqtt_disconnected(client, userdata, rc)
+
+        if not self._disconnected.done():
+            self._disconnected.set_result(rc)
+
+    async def _do_mqtt_async(self):
+        self._client = paho.Client()
+        self._client.on_message = self._mqtt_incoming
+        self._client.on_connect = self._mqtt_connected
+        self._client.on_disconnect = self._mqtt_disconnected
+        self._client.on_socket_open = self._socket_open
+        self._client.on_socket_close = self._socket_close
+        self._client.on_socket_register_write = self._socket_register_write
+        self._client.on_socket_unregister_write = self._socket_unregister_write
+        self._create_outbox()
+        self._start_local()
+
+        self._start_stats()
+
+        delay = AsyncAuthPluginRunner.RECONNECT_DELAY_MIN
+        while True:
+            self._disconnected = self._loop.create_future()
+
+            try:
+                self._client.connect(self._config.mqtt_host, port=self._config.mqtt_port)
+            except (OSError, IOError) as e:
+                logging.warning('MQTT connection failed: %s, retrying in %ss', e, delay)
+
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, AsyncAuthPluginRunner.RECONNECT_DELAY_MAX)
+                continue
+
+            delay = AsyncAuthPluginRunner.RECONNECT_DELAY_MIN
+
+            while not self._disconnected.done():
+                self._client.loop_misc()
+
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._disconnected), 1)
+                except asyncio.TimeoutError:
+                    pass
+
+            await asyncio.sleep(delay)
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._config.workers)
+        self._dispatcher = AsyncZoneDispatcher(self._loop, self._config.workers, self._config.queue_depth)
+
+        await self._do_mqtt_async()
+
+    def run(self):
+        asyncio.run(self._run())
+
+
+def main(plugin_class):
+    runner_main(plugin_class, runner_class=AsyncAuthPluginRunner)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('plugin', help='plugin class, e.g. ldapentry:LDAPAuthPlugin')
+    args, rest = parser.parse_known_args()
+
+    sys.argv = [sys.argv[0]] + rest
+    main(load_plugin_class(args.plugin))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import glob
+import gzip
+import json
+import time
+import shutil
+import logging
+import threading
+import logging.handlers
+import collections
+
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from constants import *
+from configutil import get_option
+
+AuditRecord = collections.namedtuple('AuditRecord', ['timestamp', 'zone', 'card', 'uid', 'decision', 'latency', 'message'])
+
+
+class AuditLog(object):
+    '''
+    Audit trail written by a background thread, so that logging never delays a door.
+
+    record() only queues; when the queue is full the record is dropped and
+    counted. The writer takes up to batch_size records at a time, at most
+    every flush_interval seconds unless the queue keeps filling up, and appends
+    them as JSON lines to DIRECTORY/IDENT.log, forwards them to syslog and
+    prints them. Files over segment_size are gzipped and at most segments of
+    the compressed files are kept. Without a directory only syslog and
+    stdout are written.
+
+    Syslog gets the records through a handler of its own, tagged with ident,
+    since syslog.openlog() is process-wide and several logs may share a process.
+    Use open_audit_log(), which gives every ident one AuditLog per process.
+    '''
+    def __init__(self, ident, directory=None, segment_size=16 * 1024 * 1024, segments=10,
+                 forward_syslog=True, echo=True, batch_size=256, flush_interval=1.0, queue_size=10000):
+        super(AuditLog, self).__init__()
+        self._ident = ident
+        self._directory = directory
+        self._segment_size = segment_size
+        self._segments = segments
+        self._echo = echo
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+
+        self._queue = Queue.Queue(queue_size)
+        self._file = None
+        self.dropped = 0
+
+        self._syslog = None
+        if forward_syslog:
+            self._syslog = self._syslog_handler(ident)
+
+        thread = threading.Thread(target=self._writer, name='audit')
+        thread.daemon = True
+        thread.start()
+
+    def record(self, message, zone=None, card=None, uid=None, decision=None, latency=None):
+        if not isinstance(message, str):
+            message = message.encode('utf-8')
+
+        try:
+            self._queue.put_nowait(AuditRecord(time.time(), zone, card, uid, decision, latency, message))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _syslog_handler(self, ident):
+        address = '/dev/log' if os.path.exists('/dev/log') else ('localhost', logging.handlers.SYSLOG_UDP_PORT)
+
+        try:
+            handler = logging.handlers.SysLogHandler(address, logging.handlers.SysLogHandler.LOG_LOCAL0)
+        except (IOError, OSError) as e:
+            logging.warning('Cannot forward audit records of %s to syslog: %s', ident, e)
+
+            return None
+
+        handler.setFormatter(logging.Formatter(ident + ': %(message)s'))
+
+        return handler
+
+    def _path(self):
+        return os.path.join(self._directory, '{0}.log'.format(self._ident))
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+
+        now = time.time()
+        segment = os.path.join(self._directory, '{0}-{1}{2:03d}.log.gz'.format(
+            self._ident, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(now * 1000) % 1000))
+
+        with open(self._path(), 'rb') as src:
+            dst = gzip.open(segment, 'wb')
+            try:
+                shutil.copyfileobj(src, dst)
+            finally:
+                dst.close()
+        os.remove(self._path())
+
+        for old in sorted(glob.glob(os.path.join(self._directory, '{0}-*.log.gz'.format(self._ident))))[:-self._segments]:
+            os.remove(old)
+
+    def _write(self, batch):
+        if self._directory:
+            if self._file is None:
+                self._file = open(self._path(), 'a')
+
+            for record in batch:
+                self._file.write(json.dumps(record._asdict()) + '\n')
+            self._file.flush()
+
+            if self._file.tell() >= self._segment_size:
+                self._rotate()
+
+        for record in batch:
+            if self._syslog is not None:
+                self._syslog.emit(logging.makeLogRecord({'msg': record.message, 'levelno': logging.INFO,
+                                                         'levelname': 'INFO'}))
+            if self._echo:
+                print(record.message)
+
+    def _writer(self):
+        while True:
+            batch = [self._queue.get()]
+
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            except (IOError, OSError) as e:
+                logging.error('Cannot write %d audit records: %s', len(batch), e)
+
+            if len(batch) < self._batch_size:
+                # let the next batch gather instead of waking up for every record
+                time.sleep(self._flush_interval)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'dropped': self.dropped,
+        }
+
+
+_audit_logs = {}
+_audit_logs_lock = threading.Lock()
+
+
+def open_audit_log(ident, config_files=('config.ini', 'localconfig.ini')):
+    '''
+    Returns the AuditLog of ident, configured by [audit] section of config_files when it is first opened.
+
+    Plugins in one process (plugin_host.py) share it, so only one writer appends to and rotates IDENT.log.
+    '''
+    with _audit_logs_lock:
+        audit = _audit_logs.get(ident)
+
+        if audit is None:
+            audit = _audit_logs[ident] = _create_audit_log(ident, config_files)
+
+    return audit
+
+
+def _create_audit_log(ident, config_files):
+    config_file = ConfigParser.RawConfigParser()
+    config_file.read(config_files)
+
+    return AuditLog(
+        ident,
+        directory=get_option(config_file, CONFIG_SECTION_AUDIT, CONFIG_AUDIT_DIRECTORY, ''),
+        segment_size=get_option(config_file, CONFIG_SECTION_AUDIT, CONFIG_AUDIT_SEGMENT_SIZE, 16 * 1024 * 1024),
+        segments=get_option(config_file, CONFIG_SECTION_AUDIT, CONFIG_AUDIT_SEGMENTS, 10),
+        forward_syslog=get_option(config_file, CONFIG_SECTION_AUDIT, CONFIG_AUDIT_SYSLOG, True),
+        echo=get_option(config_file, CONFIG_SECTION_AUDIT, CONFIG_AUDIT_ECHO, True),
+        flush_interval=get_option(config_file, CONFIG_SECTION_AUDIT, CONFIG_AUDIT_FLUSH_INTERVAL, 1.0))
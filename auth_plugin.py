@@ -18,13 +18,31 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import time
 import logging
 import argparse
-import ConfigParser
+import functools
+import importlib
+import threading
+import collections
+
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 import paho.mqtt.client as paho
 
 from constants import *
+from configutil import get_option
+from spool import SpooledPublisher, load_spool_config
+from protocol import ProtocolError, TOPIC_SYSTEM, TOPIC_EDGE, decode_message, encode_action
+from localipc import LocalClient
 
 
 class EnterpriseAuthPlugin(object):
@@ -49,54 +67,115 @@ class EnterpriseAuthPlugin(object):
     # def on_action(self, zoneid, action):
     # 	pass
 
-    # following ones will be patched by AuthPluginRunner
-    def accept(self, zoneid):
+    # following ones will be patched by AuthPluginRunner, uid is only recorded in the access history
+    def accept(self, zoneid, uid=None):
         pass
 
-    def reject(self, zoneid):
+    def reject(self, zoneid, uid=None):
         pass
 
+    def edge_allow(self, cardcode, zones, expires):
+        pass
 
-class AuthPluginRunner(object):
-    def __init__(self, config, plugin):
-        super(AuthPluginRunner, self).__init__()
-        self._config = config
-        self._plugin = plugin
+    def edge_revoke(self, cardcode):
+        pass
 
-        plugin.accept = self._plugin_do_accept
-        plugin.reject = self._plugin_do_reject
 
-    def _plugin_keypress(self, info, payload):
-        self._plugin.on_keypress(info[0], payload)
+class ZoneDispatcher(object):
+    '''
+    Runs plugin callbacks on a pool of worker threads, away from the MQTT network thread.
 
-    def _plugin_cardread(self, info, payload):
-        self._plugin.on_cardread(info[0], payload)
+    Events of one zone are handled one at a time and in order of arrival,
+    events of different zones are handled in parallel. Each zone queues at
+    most queue_depth events, when it is full the oldest one is dropped.
+    '''
+    def __init__(self, workers, queue_depth):
+        super(ZoneDispatcher, self).__init__()
+        self._queue_depth = queue_depth
+        self.dropped = 0
 
-    def _plugin_tamper(self, info, payload):
-        self._plugin.on_tamper(info[0])
+        self._lock = threading.Lock()
+        # zone -> pending events; a zone has an entry only while a worker owns it or it waits in _ready
+        self._queues = {}
+        self._ready = Queue.Queue()
 
-    def _plugin_watchdog(self, info, payload):
-        self._plugin.on_watchdog()
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name='dispatcher-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
 
-    def _plugin_timeout(self, info, payload):
-        self._plugin.on_timeout()
+    def dispatch(self, zone, func, *args):
+        with self._lock:
+            queue = self._queues.get(zone)
+            schedule = queue is None
 
-    def _plugin_do_accept(self, zoneid):
-        self._client.publish('enterprised/reader/{0}/action'.format(zoneid), 'accept')
+            if schedule:
+                queue = self._queues[zone] = collections.deque()
 
-    def _plugin_do_reject(self, zoneid):
-        self._client.publish('enterprised/reader/{0}/action'.format(zoneid), 'reject')
+            if len(queue) >= self._queue_depth:
+                logging.warning('Event queue of zone %s is full, dropping oldest event', zone)
 
-    def _plugin_action(self, info, payload):
-        self._plugin.on_action(info[0], payload)
+                queue.popleft()
+                self.dropped += 1
 
-    def _mqtt_incoming(self, client, userdata, message):
-        splitted = message.topic.split('/')
+            queue.append((func, args))
+
+        if schedule:
+            self._ready.put(zone)
 
-        msg_sender = splitted[2]
-        msg_type = splitted[3]
+    def _worker(self):
+        while True:
+            zone = self._ready.get()
 
-        ACTION_MAPPING = {
+            with self._lock:
+                func, args = self._queues[zone].popleft()
+
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('Plugin failed to handle event for zone %s', zone)
+
+            with self._lock:
+                reschedule = len(self._queues[zone]) > 0
+
+                if not reschedule:
+                    del self._queues[zone]
+
+            if reschedule:
+                self._ready.put(zone)
+
+
+class AuthPluginRunner(object):
+    '''
+    Connects plugins to MQTT. Several plugins can share one runner, they
+    then share its MQTT connection and every message is decoded only once.
+    '''
+    def __init__(self, config, plugins):
+        super(AuthPluginRunner, self).__init__()
+        self._config = config
+        self._plugins = list(plugins)
+        self._dispatcher = self._create_dispatcher()
+
+        self._stats_lock = threading.Lock()
+        self._stale = 0
+
+        # card read the current thread is handling: its read id and timestamps, sent along with accept/reject
+        self._context = threading.local()
+
+        self._outbox = None
+        self._local = None
+
+        # read ids of card reads handled lately, they come over the local socket and MQTT alike
+        self._seen_lock = threading.Lock()
+        self._seen_reads = collections.OrderedDict()
+
+        for plugin in self._plugins:
+            plugin.accept = functools.partial(self._plugin_do_accept, plugin)
+            plugin.reject = functools.partial(self._plugin_do_reject, plugin)
+            plugin.edge_allow = self._plugin_do_edge_allow
+            plugin.edge_revoke = self._plugin_do_edge_revoke
+
+        handlers = {
             EVENT_KEYPRESS: self._plugin_keypress,
             EVENT_CARDREAD: self._plugin_cardread,
             EVENT_TAMPER: self._plugin_tamper,
@@ -105,19 +184,244 @@ class AuthPluginRunner(object):
             EVENT_ACTION: self._plugin_action,
         }
 
+        # event -> (hook, handler, [(index, plugin) of plugins having the hook])
+        self._routes = dict(
+            (event, (hook, handlers[event],
+                     [(index, plugin) for index, plugin in enumerate(self._plugins) if hasattr(plugin, hook)]))
+            for event, hook in AuthPluginRunner.HOOKS.items())
+
+    @property
+    def name(self):
+        return ', '.join(plugin.name for plugin in self._plugins)
+
+    def _create_dispatcher(self):
+        return ZoneDispatcher(self._config.workers, self._config.queue_depth)
+
+    def _shed_stale(self, plugin, event):
+        age = time.time() - event.received
+
+        if self._config.max_age <= 0 or age <= self._config.max_age:
+            return False
+
+        with self._stats_lock:
+            self._stale += 1
+
+        logging.warning('Shedding %.1fs old event for zone %s', age, event.zone)
+
+        if self._config.stale_action == STALE_ACTION_REJECT:
+            self._plugin_do_reject(plugin, event.zone)
+
+        return True
+
+    def _current_read(self):
+        return getattr(self._context, 'read', None)
+
+    # handlers return whatever the hook returned, so that the asyncio runner can await async hooks
+    def _plugin_keypress(self, plugin, event):
+        if self._shed_stale(plugin, event):
+            return
+
+        return plugin.on_keypress(event.zone, event.value)
+
+    def _plugin_cardread(self, plugin, event):
+        self._context.read = {'read_id': event.read_id, 'received': event.received, 'started': time.time()}
+
+        try:
+            if self._shed_stale(plugin, event):
+                return
+
+            return plugin.on_cardread(event.zone, event.value)
+        finally:
+            self._context.read = None
+
+    def _plugin_tamper(self, plugin, event):
+        return plugin.on_tamper(event.zone)
+
+    def _plugin_watchdog(self, plugin, event):
+        return plugin.on_watchdog()
+
+    def _plugin_timeout(self, plugin, event):
+        return plugin.on_pingtimeout()
+
+    def _publish_action(self, plugin, zoneid, action, uid):
+        read = self._current_read()
+        read_id = None
+        trace = None
+
+        if read is not None:
+            read_id = read['read_id']
+            # lets the driver tell how long the event waited here and how long the plugin took
+            trace = {
+                'received': read['received'],
+                'started': read['started'],
+                'published': time.time(),
+            }
+
+        if self._local is not None:
+            topic, payload = encode_action(zoneid, action, read_id, plugin.name, uid, trace, direct=True)
+
+            if self._local.send(topic, payload):
+                # observers still see the answer, the driver knows to skip this copy
+                self._publish(topic, payload)
+                return
+
+        self._publish(*encode_action(zoneid, action, read_id, plugin.name, uid, trace))
+
+    def _plugin_do_accept(self, plugin, zoneid, uid=None):
+        self._publish_action(plugin, zoneid, ACTION_ACCEPT, uid)
+
+    def _plugin_do_reject(self, plugin, zoneid, uid=None):
+        self._publish_action(plugin, zoneid, ACTION_REJECT, uid)
+
+    def _plugin_do_edge_allow(self, cardcode, zones, expires):
+        self._publish(TOPIC_EDGE, json.dumps({
+            'op': EDGE_ALLOW,
+            'card': str(cardcode),
+            'zones': [str(zone) for zone in zones],
+            'expires': expires,
+            'version': int(time.time() * 1000),
+        }))
+
+    def _plugin_do_edge_revoke(self, cardcode):
+        self._publish(TOPIC_EDGE, json.dumps({
+            'op': EDGE_REVOKE,
+            'card': str(cardcode),
+            'version': int(time.time() * 1000),
+        }))
+
+    def _plugin_action(self, plugin, event):
+        return plugin.on_action(event.zone, event.value)
+
+    def _publish_stats(self):
+        published = None
+
+        while True:
+            time.sleep(self._config.stats_interval)
+
+            with self._stats_lock:
+                stats = (self._stale, self._dispatcher.dropped)
+
+            spool = self._outbox.stats() if self._outbox is not None else None
+            plugins = dict((plugin.name, plugin.stats()) for plugin in self._plugins if hasattr(plugin, 'stats'))
+
+            if (stats, spool, plugins) == published:
+                continue
+
+            self._publish(TOPIC_SYSTEM, json.dumps({
+                'event': EVENT_SHED,
+                'plugin': self.name,
+                'stale': stats[0],
+                'overflow': stats[1],
+                'spool': spool,
+                'plugins': plugins,
+            }))
+            published = (stats, spool, plugins)
+
+    HOOKS = {
+        EVENT_KEYPRESS: 'on_keypress',
+        EVENT_CARDREAD: 'on_cardread',
+        EVENT_TAMPER: 'on_tamper',
+        EVENT_TIMEOUT: 'on_pingtimeout',
+        EVENT_WATCHDOG: 'on_watchdog',
+        EVENT_ACTION: 'on_action',
+    }
+
+    SEEN_READS_KEPT = 1024
+
+    def _seen(self, read_id):
+        '''
+        Returns True when a read with read_id was routed before, remembers it otherwise.
+        '''
+        with self._seen_lock:
+            if read_id in self._seen_reads:
+                return True
+
+            self._seen_reads[read_id] = True
+            if len(self._seen_reads) > AuthPluginRunner.SEEN_READS_KEPT:
+                self._seen_reads.popitem(last=False)
+
+            return False
+
+    def _route(self, topic, payload, direct=False):
+        '''
+        Returns (event, hook, handler, plugins having the hook) for a message, or None when it should be ignored.
+
+        direct is set for messages from the local socket.
+        '''
         try:
-            ACTION_MAPPING[msg_type](splitted[2:], message.payload)
+            event = decode_message(topic, payload)
+        except ProtocolError:
+            logging.warning('Invalid system message %s', payload)
+
+            return None
+
+        if event is None:
+            return None
+
+        if event.event != EVENT_ACTION and self._local is not None:
+            if event.read_id is not None:
+                # a card read published just before the local link came up reaches us only over MQTT,
+                # so either copy is taken, whichever comes first
+                if self._seen(event.read_id):
+                    return None
+            elif not direct and self._local.connected:
+                # other events of the driver come over the local socket, actions of other plugins only over MQTT
+                return None
+
+        try:
+            hook, handler, plugins = self._routes[event.event]
         except KeyError:
-            logging.warning('MQTT unknown event %s', msg['event'])
+            logging.warning('MQTT unknown event %s', event.event)
+
+            return None
+
+        return event, hook, handler, plugins
+
+    def _deliver(self, route):
+        event, hook, handler, plugins = route
+
+        # each plugin keeps its own per-zone order, a slow plugin does not hold up the others
+        for index, plugin in plugins:
+            self._dispatcher.dispatch((index, event.zone), handler, plugin, event)
+
+    def _mqtt_incoming(self, client, userdata, message):
+        route = self._route(message.topic, message.payload)
+
+        if route is not None:
+            self._deliver(route)
+
+    def _local_incoming(self, topic, payload):
+        route = self._route(topic, payload, direct=True)
+
+        if route is not None:
+            self._deliver(route)
 
     def _request_signal(self, name, path):
-        try:
-            getattr(self._plugin, name)
+        if any(hasattr(plugin, name) for plugin in self._plugins):
             self._client.subscribe(path)
-        except AttributeError:
-            pass
+
+    def _publish(self, topic, payload):
+        if self._outbox is not None:
+            self._outbox.publish(topic, payload)
+        else:
+            self._client.publish(topic, payload)
+
+    def _start_local(self):
+        if self._config.ipc_socket:
+            self._local = LocalClient(self._config.ipc_socket, self._local_incoming)
+
+    def _create_outbox(self):
+        if self._config.spool is not None:
+            self._outbox = SpooledPublisher(self._client, self._config.spool.open('plugin-' + self.name))
+
+    def _mqtt_disconnected(self, client, userdata, rc):
+        if self._outbox is not None:
+            self._outbox.disconnected()
 
     def _mqtt_connected(self, client, userdata, flags, rc):
+        if self._outbox is not None:
+            self._outbox.connected()
+
         self._request_signal('on_keypress', 'enterprised/reader/+/keypress')
         self._request_signal('on_cardread', 'enterprised/reader/+/cardread')
         self._request_signal('on_tamper', 'enterprised/reader/+/tamper')
@@ -127,11 +431,23 @@ class AuthPluginRunner(object):
 
         self._request_signal('on_action', 'enterprised/reader/+/action')
 
+    def _start_stats(self):
+        if self._config.stats_interval > 0:
+            thread = threading.Thread(target=self._publish_stats)
+            thread.daemon = True
+            thread.start()
+
     def _do_mqtt(self):
         self._client = paho.Client()
         self._client.on_message = self._mqtt_incoming
         self._client.on_connect = self._mqtt_connected
+        self._client.on_disconnect = self._mqtt_disconnected
+        self._create_outbox()
+        self._start_local()
         self._client.connect(self._config.mqtt_host, port=self._config.mqtt_port)
+
+        self._start_stats()
+
         self._client.loop_forever()
 
     def run(self):
@@ -144,11 +460,34 @@ class MQTTConfig(object):
         self.mqtt_port = mqtt_port
 
 
-def main(plugin_class):
-    plugin = plugin_class()
+class AuthPluginRunnerConfig(MQTTConfig):
+    def __init__(self, mqtt_host, mqtt_port, workers, queue_depth, max_age, stale_action, stats_interval,
+                 spool=None, ipc_socket=None):
+        super(AuthPluginRunnerConfig, self).__init__(mqtt_host, mqtt_port)
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.max_age = max_age
+        self.stale_action = stale_action
+        self.stats_interval = stats_interval
+        self.spool = spool
+        self.ipc_socket = ipc_socket
+
+
+def load_plugin_class(spec):
+    '''
+    Returns plugin class named by spec, e.g. 'ldapentry:LDAPAuthPlugin'.
+    '''
+    module_name, _, class_name = spec.partition(':')
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def run_plugins(plugin_classes, runner_class=AuthPluginRunner):
+    plugins = [plugin_class() for plugin_class in plugin_classes]
 
     parser = argparse.ArgumentParser(
-        description='Enterprise RFID Unique (EM4100) Access Controller Plugin - {0}'.format(plugin.name))
+        description='Enterprise RFID Unique (EM4100) Access Controller Plugin - {0}'.format(
+            ', '.join(plugin.name for plugin in plugins)))
     parser.add_argument('--log', default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
                         help='log level')
     args = parser.parse_args()
@@ -161,13 +500,24 @@ def main(plugin_class):
     config_file = ConfigParser.RawConfigParser()
     config_file.read(['config.ini', 'localconfig.ini'])
 
-    config = MQTTConfig(
+    config = AuthPluginRunnerConfig(
         mqtt_host=config_file.get(CONFIG_SECTION_MQTT, CONFIG_MQTT_HOST),
-        mqtt_port=config_file.getint(CONFIG_SECTION_MQTT, CONFIG_MQTT_PORT))
-
-    enterprise_driver = AuthPluginRunner(config=config, plugin=plugin)
+        mqtt_port=config_file.getint(CONFIG_SECTION_MQTT, CONFIG_MQTT_PORT),
+        workers=get_option(config_file, CONFIG_SECTION_RUNNER, CONFIG_RUNNER_WORKERS, 4),
+        queue_depth=get_option(config_file, CONFIG_SECTION_RUNNER, CONFIG_RUNNER_QUEUE_DEPTH, 16),
+        max_age=get_option(config_file, CONFIG_SECTION_RUNNER, CONFIG_RUNNER_MAX_AGE, 5.0),
+        stale_action=get_option(config_file, CONFIG_SECTION_RUNNER, CONFIG_RUNNER_STALE_ACTION, STALE_ACTION_REJECT),
+        stats_interval=get_option(config_file, CONFIG_SECTION_RUNNER, CONFIG_RUNNER_STATS_INTERVAL, 60),
+        spool=load_spool_config(config_file),
+        ipc_socket=get_option(config_file, CONFIG_SECTION_IPC, CONFIG_IPC_SOCKET, '') or None)
+
+    enterprise_driver = runner_class(config=config, plugins=plugins)
     enterprise_driver.run()
 
 
+def main(plugin_class, runner_class=AuthPluginRunner):
+    run_plugins([plugin_class], runner_class)
+
+
 if __name__ == '__main__':
-    print 'Implement your own plugin, see example: pinentry.py'
+    print('Implement your own plugin, see example: pinentry.py')
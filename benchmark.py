@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmark of the whole pipeline without any hardware, broker or directory.
+
+Everything runs in this one process: a simulated IO board on socket://,
+a minimal MQTT broker, EnterpriseDriver, and LDAPAuthPlugin on an ldap3
+MOCK_SYNC directory. The board swipes cards at the given rate and measures
+the time from sending *C# to getting *A#/*R# back.
+
+    python benchmark.py --rate 20 --duration 30 --members 5000
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json   # exits with 1 on regression
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import struct
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import collections
+
+import ldap3
+
+from constants import *
+
+MEMBERS_GROUP = 'cn=members,cn=groups,cn=accounts,dc=at,dc=hskrk,dc=pl'
+USERS_BASE = 'cn=users,cn=accounts,dc=at,dc=hskrk,dc=pl'
+BIND_DN = 'uid=bench,cn=sysaccounts,dc=at,dc=hskrk,dc=pl'
+BIND_PW = 'bench'
+FIRST_CARD = 1000000
+
+
+class SimulatedBoard(object):
+    '''
+    IO board the driver reaches with serial_for_url('socket://127.0.0.1:PORT').
+
+    Answers pings, and once started swipes random cards at rate per second
+    (Poisson arrivals) on the given zones, mixed with an occasional key press
+    and tamper. Latency is measured per zone, answers are matched to swipes in order.
+    '''
+    def __init__(self, zones, cards, unknown_ratio):
+        super(SimulatedBoard, self).__init__()
+        self._zones = zones
+        self._cards = cards
+        self._unknown_ratio = unknown_ratio
+
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+        self.url = 'socket://127.0.0.1:{0}'.format(self._server.getsockname()[1])
+
+        self._lock = threading.Lock()
+        self._pending = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.accepted = 0
+        self.rejected = 0
+        self.swipes = 0
+        self.last_answer = None
+
+        self._start_thread(self._serve)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _send(self, frame):
+        self._connection.sendall(frame.encode('ascii') + b'\n')
+
+    def _serve(self):
+        self._connection, _ = self._server.accept()
+        buf = b''
+
+        while True:
+            data = self._connection.recv(4096)
+            if not data:
+                return
+
+            lines = (buf + data).split(b'\n')
+            buf = lines.pop()
+
+            for line in lines:
+                self._received(line.strip().decode('ascii'), time.time())
+
+    def _received(self, line, now):
+        if line == '*P#':
+            self._send('*P')
+            return
+
+        if line[:3] not in ('*A#', '*R#'):
+            return
+
+        with self._lock:
+            pending = self._pending[int(line[3:])]
+            if not pending:
+                return
+
+            self.latencies.append(now - pending.popleft())
+            self.last_answer = now
+            if line[1] == 'A':
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+    def swipe(self, rate, duration):
+        deadline = time.time() + duration
+
+        while time.time() < deadline:
+            time.sleep(random.expovariate(rate))
+
+            zone = random.choice(self._zones)
+            dice = random.random()
+
+            if dice < 0.02:
+                self._send('*K#{0}#{1}'.format(zone, random.randint(0, 9)))
+            elif dice < 0.025:
+                self._send('*T#{0}'.format(zone))
+            else:
+                if random.random() < self._unknown_ratio:
+                    card = random.randint(1, FIRST_CARD - 1)
+                else:
+                    card = random.choice(self._cards)
+
+                with self._lock:
+                    self._pending[zone].append(time.time())
+                    self.swipes += 1
+
+                self._send('*C#{0}#{1}'.format(zone, card))
+
+    def unanswered(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+
+class LocalBroker(object):
+    '''
+    Just enough of an MQTT 3.1.1 broker for paho clients on one host.
+
+    QoS 1 publishes are acknowledged but delivered with QoS 0, retained
+    messages, wills and sessions are not supported.
+    '''
+    def __init__(self):
+        super(LocalBroker, self).__init__()
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+
+        self._lock = threading.Lock()
+        self._subscriptions = []  # (filter, connection, send lock)
+        self.messages = 0
+
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def matches(topic_filter, topic):
+        filter_levels = topic_filter.split('/')
+        levels = topic.split('/')
+
+        for i, level in enumerate(filter_levels):
+            if level == '#':
+                return True
+            if i >= len(levels) or (level != '+' and level != levels[i]):
+                return False
+
+        return len(filter_levels) == len(levels)
+
+    @staticmethod
+    def _packet(packet_type, body):
+        length = len(body)
+        encoded = bytearray()
+
+        while True:
+            byte = length % 128
+            length //= 128
+            encoded.append(byte | 0x80 if length else byte)
+            if not length:
+                break
+
+        return bytes(bytearray([packet_type]) + encoded) + body
+
+    @staticmethod
+    def _read_exactly(connection, size):
+        data = b''
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+
+        return data
+
+    def _read_packet(self, connection):
+        header = bytearray(self._read_exactly(connection, 1))[0]
+
+        length = 0
+        multiplier = 1
+        while True:
+            byte = bytearray(self._read_exactly(connection, 1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+
+        return header, self._read_exactly(connection, length)
+
+    def _accept(self):
+        while True:
+            connection, _ = self._server.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            thread = threading.Thread(target=self._client, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _client(self, connection):
+        send_lock = threading.Lock()
+
+        def send(data):
+            with send_lock:
+                connection.sendall(data)
+
+        try:
+            while True:
+                header, body = self._read_packet(connection)
+                packet_type = header >> 4
+
+                if packet_type == 1:  # CONNECT
+                    send(self._packet(0x20, b'\x00\x00'))
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 3
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode('utf-8')
+                    offset = 2 + topic_length
+
+                    if qos:
+                        send(self._packet(0x40, body[offset:offset + 2]))
+                        offset += 2
+
+                    self._deliver(topic, body[offset:])
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id, offset, granted = body[:2], 2, b''
+                    while offset < len(body):
+                        filter_length = struct.unpack('!H', body[offset:offset + 2])[0]
+                        topic_filter = body[offset + 2:offset + 2 + filter_length].decode('utf-8')
+                        offset += 3 + filter_length
+                        granted += b'\x00'
+
+                        with self._lock:
+                            self._subscriptions.append((topic_filter, connection, send))
+
+                    send(self._packet(0x90, packet_id + granted))
+                elif packet_type == 10:  # UNSUBSCRIBE
+                    send(self._packet(0xb0, body[:2]))
+                elif packet_type == 12:  # PINGREQ
+                    send(self._packet(0xd0, b''))
+                elif packet_type == 14:  # DISCONNECT
+                    break
+        except (EOFError, socket.error):
+            pass
+        finally:
+            with self._lock:
+                self._subscriptions = [s for s in self._subscriptions if s[1] is not connection]
+            connection.close()
+
+    def _deliver(self, topic, payload):
+        encoded = topic.encode('utf-8')
+        packet = self._packet(0x30, struct.pack('!H', len(encoded)) + encoded + payload)
+
+        with self._lock:
+            self.messages += 1
+            # one copy per client, however many of its filters match
+            targets = dict((connection, send) for topic_filter, connection, send in self._subscriptions
+                           if self.matches(topic_filter, topic))
+
+        for send in targets.values():
+            try:
+                send(packet)
+            except socket.error:
+                pass
+
+
+def seed_directory(server, members):
+    '''
+    Fills the MOCK_SYNC server with the bind account and members with paid membership; returns their cards.
+    '''
+    connection = ldap3.Connection(server, user=BIND_DN, password=BIND_PW, client_strategy=ldap3.MOCK_SYNC)
+    connection.strategy.add_entry(BIND_DN, {'userPassword': BIND_PW, 'objectClass': 'person'})
+
+    paid_until = int(time.time()) // (24 * 60 * 60) + 30
+    cards = []
+
+    for i in range(members):
+        card = str(FIRST_CARD + i)
+        connection.strategy.add_entry('uid=member{0},{1}'.format(i, USERS_BASE), {
+            'uid': 'member{0}'.format(i),
+            'uniqueCardId': card,
+            'memberOf': [MEMBERS_GROUP],
+            'membershipExpiration': str(paid_until),
+            'modifyTimestamp': '20160101000000Z',
+            'objectClass': 'person',
+        })
+        cards.append(card)
+
+    return cards
+
+
+def write_config(directory, sync_interval):
+    with open(os.path.join(directory, 'ldap.ini'), 'w') as f:
+        f.write('[ldap]\nurl=ldap://bench\nbinddn={0}\nbindpw={1}\nsearch_base={2}\n'
+                'sync_interval={3}\n'.format(BIND_DN, BIND_PW, USERS_BASE, sync_interval))
+
+    with open(os.path.join(directory, 'config.ini'), 'w') as f:
+        f.write('[audit]\nsyslog=false\necho=false\n')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='enterprised-bench-')
+    write_config(workdir, args.sync_interval)
+    # ldapentry and audit read their configuration from the working directory on import
+    os.chdir(workdir)
+
+    import ldapentry
+    import enterprised
+    from auth_plugin import AuthPluginRunner, AuthPluginRunnerConfig
+
+    directory = ldap3.Server('bench')
+    cards = seed_directory(directory, args.members)
+
+    def connect_mock(pool):
+        connection = ldap3.Connection(directory, user=pool._user, password=pool._password,
+                                      client_strategy=ldap3.MOCK_SYNC)
+        connection.bind()
+
+        return connection
+
+    # the pool itself is kept, only its connections go to the mock directory
+    ldapentry.LDAPConnectionPool._connect = connect_mock
+
+    zones = list(range(1, args.zones + 1))
+    board = SimulatedBoard(zones, cards, args.unknown_ratio)
+    broker = LocalBroker()
+
+    ipc_socket = os.path.join(workdir, 'enterprised.sock') if args.ipc else None
+
+    driver = enterprised.EnterpriseDriver(enterprised.EnterpriseDriverConfig(
+        board.url, 19200, '127.0.0.1', broker.port,
+        decision_deadline=args.deadline, debounce_window=0, ipc_socket=ipc_socket))
+
+    plugin = ldapentry.LDAPAuthPlugin()
+    runner = AuthPluginRunner(AuthPluginRunnerConfig(
+        '127.0.0.1', broker.port, args.workers, 16, args.deadline, STALE_ACTION_REJECT, 0,
+        ipc_socket=ipc_socket), [plugin])
+
+    for target in (driver.run, runner.run):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    # let both connect and the directory index finish its first sync
+    time.sleep(args.warmup)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+
+    board.swipe(args.rate, args.duration)
+
+    # until the driver is done with every read, a read decided by the deadline is answered late, not lost
+    drain_until = time.time() + args.deadline + 1
+    while board.unanswered() and time.time() < drain_until:
+        if (not driver._decisions.stats()['pending'] and driver._io_queue.empty()
+                and all(io_board._out_queue.empty() for io_board in driver._boards)):
+            break
+
+        time.sleep(0.05)
+
+    finished = board.last_answer or time.time()
+    elapsed = finished - started
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_after.ru_utime - usage.ru_utime) + (usage_after.ru_stime - usage.ru_stime)
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'params': {
+            'rate': args.rate,
+            'duration': args.duration,
+            'members': args.members,
+            'zones': args.zones,
+            'workers': args.workers,
+            'sync_interval': args.sync_interval,
+            'unknown_ratio': args.unknown_ratio,
+            'ipc': args.ipc,
+        },
+        'swipes': board.swipes,
+        'answered': len(board.latencies),
+        'coalesced': sum(io_board.stats()['coalesced'] for io_board in driver._boards),
+        'accepted': board.accepted,
+        'rejected': board.rejected,
+        'swipes_per_sec': len(board.latencies) / elapsed,
+        'latency_p50': percentile(board.latencies, 50),
+        'latency_p99': percentile(board.latencies, 99),
+        'latency_max': max(board.latencies) if board.latencies else None,
+        'mqtt_messages': broker.messages,
+        'cpu_percent': 100.0 * cpu / elapsed,
+        'max_rss_kb': usage_after.ru_maxrss,
+    }
+
+
+# share of unanswered swipes tolerated beyond the baseline's
+UNANSWERED_SLACK = 0.01
+
+
+def unanswered_ratio(result):
+    # a command still queued for a zone takes in a second identical one, which leaves that swipe unanswered
+    lost = result['swipes'] - result['answered'] - result.get('coalesced', 0)
+    return max(lost, 0) / float(max(result['swipes'], 1))
+
+
+def compare(result, baseline, tolerance):
+    '''
+    Returns regressions of result against baseline, as text lines.
+    '''
+    regressions = []
+
+    if result['swipes_per_sec'] < baseline['swipes_per_sec'] * (1 - tolerance):
+        regressions.append('throughput {0:.1f}/s, baseline {1:.1f}/s'.format(
+            result['swipes_per_sec'], baseline['swipes_per_sec']))
+
+    for key in ('latency_p50', 'latency_p99'):
+        if result[key] is not None and baseline[key] is not None and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append('{0} {1:.1f} ms, baseline {2:.1f} ms'.format(
+                key, result[key] * 1000, baseline[key] * 1000))
+
+    unanswered = unanswered_ratio(result)
+    allowed = unanswered_ratio(baseline) * (1 + tolerance) + UNANSWERED_SLACK
+    if unanswered > allowed:
+        regressions.append('{0} of {1} swipes not answered, {2:.1%} allowed'.format(
+            result['swipes'] - result['answered'], result['swipes'], allowed))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enterprise RFID pipeline benchmark')
+    parser.add_argument('--rate', type=float, default=20, help='swipes per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of swiping')
+    parser.add_argument('--members', type=int, default=2000, help='members in the mock directory')
+    parser.add_argument('--zones', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=4, help='plugin runner workers')
+    parser.add_argument('--unknown-ratio', type=float, default=0.05, help='share of swipes with unknown cards')
+    parser.add_argument('--sync-interval', type=int, default=60,
+                        help='directory index sync interval, 0 looks every card up in LDAP')
+    parser.add_argument('--ipc', action='store_true', help='plugins talk to the driver over a unix socket')
+    parser.add_argument('--deadline', type=float, default=5.0, help='decision deadline in the driver')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds to wait before swiping')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the result as the new baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with baseline, exit with 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    for option in ('save_baseline', 'baseline'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    result = run(args)
+    status = 0
+
+    print('swipes:      {0} ({1} answered, {2} accepted, {3} rejected)'.format(
+        result['swipes'], result['answered'], result['accepted'], result['rejected']))
+    print('throughput:  {0:.1f} swipes/s'.format(result['swipes_per_sec']))
+    if result['answered']:
+        print('latency:     p50 {0:.1f} ms, p99 {1:.1f} ms, max {2:.1f} ms'.format(
+            result['latency_p50'] * 1000, result['latency_p99'] * 1000, result['latency_max'] * 1000))
+    print('cpu:         {0:.0f}%, max rss {1} kB'.format(result['cpu_percent'], result['max_rss_kb']))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline['params'] != result['params']:
+            print('warning: baseline was taken with different parameters: {0}'.format(baseline['params']))
+
+        regressions = compare(result, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+
+        if regressions:
+            status = 1
+
+    # the driver's and the runner's threads would die noisily during interpreter shutdown
+    sys.stdout.flush()
+    os._exit(status)
+
+
+if __name__ == '__main__':
+    main()
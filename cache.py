@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import time
+import struct
+import hashlib
+import logging
+import threading
+import collections
+
+
+class TTLCache(object):
+    '''
+    Bounded LRU cache with time to live and stale-while-revalidate.
+
+    Entries younger than ttl are served as they are. Entries younger than
+    ttl + grace are served immediately too, but get refreshed by loader in
+    a background thread. Missing or older entries are loaded synchronously.
+    Loader returning None means there is nothing to cache for the key.
+    '''
+
+    def __init__(self, ttl, grace, size):
+        super(TTLCache, self).__init__()
+        self._ttl = ttl
+        self._grace = grace
+        self._size = size
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+
+            if value is None:
+                return
+
+            self._entries[key] = (value, time.time())
+
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _refresh(self, key, loader):
+        try:
+            self.put(key, loader(key))
+        except Exception:
+            logging.exception('Background refresh of %s failed, keeping stale entry', key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh_async(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+
+            self._refreshing.add(key)
+
+        thread = threading.Thread(target=self._refresh, args=(key, loader))
+        thread.daemon = True
+        thread.start()
+
+    def get(self, key, loader):
+        with self._lock:
+            item = self._entries.pop(key, None)
+
+            if item is not None:
+                self._entries[key] = item
+
+        if item is not None:
+            value, stored_at = item
+            age = time.time() - stored_at
+
+            if age < self._ttl:
+                return value
+
+            if age < self._ttl + self._grace:
+                self._refresh_async(key, loader)
+
+                return value
+
+        value = loader(key)
+        self.put(key, value)
+
+        return value
+
+
+class NegativeCache(object):
+    '''
+    Bounded set of keys known to have nothing behind them, each forgotten after ttl seconds.
+    '''
+    def __init__(self, ttl, size):
+        super(NegativeCache, self).__init__()
+        self._ttl = ttl
+        self._size = size
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.time()
+
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            stored_at = self._entries.get(key)
+
+            if stored_at is None:
+                return False
+
+            if time.time() - stored_at >= self._ttl:
+                del self._entries[key]
+
+                return False
+
+            return True
+
+
+class BloomFilter(object):
+    '''
+    Set membership in a fixed bit array: no false negatives, false positives at about error_rate
+    while at most capacity keys were added.
+    '''
+    def __init__(self, capacity, error_rate=0.001):
+        super(BloomFilter, self).__init__()
+        capacity = max(capacity, 1)
+
+        self._bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(int(round(self._bits / float(capacity) * math.log(2))), 1)
+        self._array = bytearray((self._bits + 7) // 8)
+
+    @classmethod
+    def from_keys(cls, keys, error_rate=0.001, headroom=2):
+        '''
+        Returns a filter of keys, with room for headroom times as many before error_rate is exceeded.
+        '''
+        keys = list(keys)
+        bloom = cls(len(keys) * headroom, error_rate)
+
+        for key in keys:
+            bloom.add(key)
+
+        return bloom
+
+    def _positions(self, key):
+        # double hashing, k positions from the two halves of one digest
+        first, second = struct.unpack('<QQ', hashlib.md5(str(key).encode('utf-8')).digest())
+
+        return [(first + i * second) % self._bits for i in range(self._hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        array = self._array
+
+        for position in self._positions(key):
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+    @property
+    def size(self):
+        return len(self._array)
+
+
+class AttemptRate(object):
+    '''
+    Counts events per key (e.g. swipes of unknown cards per zone) over the last window seconds.
+    '''
+    def __init__(self, window):
+        super(AttemptRate, self).__init__()
+        self._window = window
+        self._lock = threading.Lock()
+        self._attempts = collections.defaultdict(collections.deque)
+
+    def _trim(self, attempts, now):
+        while attempts and now - attempts[0] >= self._window:
+            attempts.popleft()
+
+    def hit(self, key):
+        '''
+        Records an attempt and returns how many there were within the window, this one included.
+        '''
+        now = time.time()
+
+        with self._lock:
+            attempts = self._attempts[key]
+            self._trim(attempts, now)
+            attempts.append(now)
+
+            return len(attempts)
+
+    def rates(self):
+        '''
+        Returns {key: attempts within the window} of keys that had any.
+        '''
+        now = time.time()
+
+        with self._lock:
+            for key, attempts in list(self._attempts.items()):
+                self._trim(attempts, now)
+
+                if not attempts:
+                    del self._attempts[key]
+
+            return dict((key, len(attempts)) for key, attempts in self._attempts.items())
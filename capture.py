@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+import struct
+import threading
+
+
+class CaptureError(Exception):
+    pass
+
+
+MAGIC = b'ECP1'
+HEADER_LENGTH = struct.Struct('<H')
+CHUNK = struct.Struct('<dBH')  # time read, board number, length
+# bytes gathered without a newline before they are written anyway, well over the longest frame
+MAX_PARTIAL = 1024
+
+
+class CaptureWriter(object):
+    '''
+    Records bytes read from IO boards with the time they were read.
+
+    Bytes are gathered per board until a line is complete, so a chunk carries
+    the time its last line arrived, which is when the driver could act on it.
+    Line noise without newlines is written once MAX_PARTIAL bytes gathered,
+    in chunks no longer than CHUNK can describe. The file starts with the names of the boards, chunks refer to them by number.
+    It is flushed at most every flush_interval seconds.
+    '''
+    def __init__(self, path, boards, flush_interval=1.0):
+        super(CaptureWriter, self).__init__()
+        self._boards = dict((name, number) for number, name in enumerate(boards))
+        self._partial = dict((name, b'') for name in boards)
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+        header = json.dumps({'boards': list(boards), 'started': time.time()}).encode('utf-8')
+
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        self._file.flush()
+
+    def write(self, board, data, read_at):
+        with self._lock:
+            data = self._partial[board] + data
+
+            if b'\n' not in data and len(data) <= MAX_PARTIAL:
+                self._partial[board] = data
+                return
+
+            self._partial[board] = b''
+
+            for start in range(0, len(data), MAX_PARTIAL):
+                chunk = data[start:start + MAX_PARTIAL]
+                self._file.write(CHUNK.pack(read_at, self._boards[board], len(chunk)) + chunk)
+
+            if read_at - self._last_flush >= self._flush_interval:
+                self._file.flush()
+                self._last_flush = read_at
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    '''
+    Yields (time read, board name, data) from a capture file.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureError('{0} is not a capture file'.format(path))
+
+        length = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))[0]
+        boards = json.loads(f.read(length).decode('utf-8'))['boards']
+
+        while True:
+            chunk = f.read(CHUNK.size)
+            if len(chunk) < CHUNK.size:
+                # a capture cut short by a crash ends with a partial chunk
+                return
+
+            read_at, board, length = CHUNK.unpack(chunk)
+            data = f.read(length)
+            if len(data) < length:
+                return
+
+            yield read_at, boards[board], data
+
+
+class DiscardPort(object):
+    '''
+    Stands in for the serial port of a board during a replay; what the driver sends goes nowhere.
+    '''
+    def write(self, data):
+        return len(data)
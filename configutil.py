@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+def get_option(config_file, section, option, default):
+    '''
+    Returns optional setting from config_file, or default when it is not set.
+
+    Value is converted to the type of default (bool, int, float or string).
+    '''
+    if not config_file.has_option(section, option):
+        return default
+
+    if isinstance(default, bool):
+        return config_file.getboolean(section, option)
+    if isinstance(default, int):
+        return config_file.getint(section, option)
+    if isinstance(default, float):
+        return config_file.getfloat(section, option)
+
+    return config_file.get(section, option)
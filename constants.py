@@ -21,15 +21,98 @@ CONFIG_SECTION_SERIAL = 'connection'
 CONFIG_SERIAL_PORT = 'serial_port'
 CONFIG_SERIAL_SPEED = 'speed'
 
+CONFIG_SECTION_BOARD_PREFIX = 'board:'
+CONFIG_BOARD_ZONES = 'zones'
+
+CONFIG_SECTION_EDGE = 'edge'
+CONFIG_EDGE_CACHE_SIZE = 'cache_size'
+CONFIG_EDGE_CACHE_FILE = 'cache_file'
+
+CONFIG_SECTION_DECISION = 'decision'
+CONFIG_DECISION_MODE = 'mode'
+CONFIG_DECISION_PLUGINS = 'plugins'
+CONFIG_DECISION_DEADLINE = 'deadline'
+CONFIG_DECISION_DEFAULT_ACTION = 'default_action'
+
+DECISION_FIRST_ANSWER = 'first_answer'
+DECISION_FIRST_ACCEPT = 'first_accept'
+DECISION_ALL_AGREE = 'all_agree'
+
+CONFIG_SECTION_DEBOUNCE = 'debounce'
+CONFIG_DEBOUNCE_WINDOW = 'window'
+CONFIG_DEBOUNCE_UNTIL_DECIDED = 'until_decided'
+
+CONFIG_SECTION_SPOOL = 'spool'
+CONFIG_SPOOL_DIRECTORY = 'directory'
+CONFIG_SPOOL_SIZE = 'size'
+CONFIG_SPOOL_SYNC_INTERVAL = 'sync_interval'
+CONFIG_SPOOL_EVICT = 'evict'
+
+SPOOL_EVICT_OLDEST = 'oldest'
+SPOOL_EVICT_NEWEST = 'newest'
+
+CONFIG_SECTION_AUDIT = 'audit'
+CONFIG_AUDIT_DIRECTORY = 'directory'
+CONFIG_AUDIT_SEGMENT_SIZE = 'segment_size'
+CONFIG_AUDIT_SEGMENTS = 'segments'
+CONFIG_AUDIT_SYSLOG = 'syslog'
+CONFIG_AUDIT_ECHO = 'echo'
+CONFIG_AUDIT_FLUSH_INTERVAL = 'flush_interval'
+
+CONFIG_SECTION_HISTORY = 'history'
+CONFIG_HISTORY_DIRECTORY = 'directory'
+CONFIG_HISTORY_RETENTION = 'retention'
+
+CONFIG_SECTION_METRICS = 'metrics'
+CONFIG_METRICS_ADDRESS = 'address'
+CONFIG_METRICS_PORT = 'port'
+
+CONFIG_SECTION_IPC = 'ipc'
+CONFIG_IPC_SOCKET = 'socket'
+
 CONFIG_SECTION_MQTT = 'mqtt'
 CONFIG_MQTT_HOST = 'host'
 CONFIG_MQTT_PORT = 'port'
 
+CONFIG_SECTION_RUNNER = 'runner'
+CONFIG_RUNNER_WORKERS = 'workers'
+CONFIG_RUNNER_QUEUE_DEPTH = 'queue_depth'
+CONFIG_RUNNER_MAX_AGE = 'max_age'
+CONFIG_RUNNER_STALE_ACTION = 'stale_action'
+CONFIG_RUNNER_STATS_INTERVAL = 'stats_interval'
+
+STALE_ACTION_REJECT = 'reject'
+STALE_ACTION_DROP = 'drop'
+
 CONFIG_SECTION_LDAP = 'ldap'
 CONFIG_LDAP_URL = 'url'
 CONFIG_LDAP_BINDDN = 'binddn'
 CONFIG_LDAP_BINDPW = 'bindpw'
 CONFIG_LDAP_SEARCH_BASE = 'search_base'
+CONFIG_LDAP_TIMEOUT = 'timeout'
+CONFIG_LDAP_POOL_SIZE = 'pool_size'
+CONFIG_LDAP_POOL_IDLE_CHECK = 'pool_idle_check'
+CONFIG_LDAP_CACHE_TTL = 'cache_ttl'
+CONFIG_LDAP_CACHE_GRACE = 'cache_grace'
+CONFIG_LDAP_CACHE_SIZE = 'cache_size'
+CONFIG_LDAP_SYNC_INTERVAL = 'sync_interval'
+CONFIG_LDAP_FULL_SYNC_INTERVAL = 'full_sync_interval'
+CONFIG_LDAP_SYNC_MAX_AGE = 'sync_max_age'
+CONFIG_LDAP_PAGE_SIZE = 'page_size'
+CONFIG_LDAP_EDGE_ALLOW = 'edge_allow'
+CONFIG_LDAP_NEGATIVE_TTL = 'negative_ttl'
+CONFIG_LDAP_SCAN_THRESHOLD = 'scan_threshold'
+
+CONFIG_SECTION_POLICY_PREFIX = 'policy:'
+CONFIG_POLICY_GROUP = 'group'
+CONFIG_POLICY_ZONES = 'zones'
+CONFIG_POLICY_SPONSOR = 'sponsor'
+CONFIG_POLICY_EXPIRATION = 'expiration'
+
+CONFIG_SECTION_SKLADKI = 'skladki'
+CONFIG_SKLADKI_DEADLINE = 'deadline'
+CONFIG_SKLADKI_WORKERS = 'workers'
+CONFIG_SKLADKI_NEGATIVE_TTL = 'negative_ttl'
 
 EVENT_KEYPRESS = 'keypress'
 EVENT_CARDREAD = 'cardread'
@@ -38,3 +121,13 @@ EVENT_TIMEOUT = 'timeout'
 EVENT_WATCHDOG = 'watchdog'
 EVENT_SHUTDOWN = 'shutdown'
 EVENT_ACTION = 'action'
+EVENT_SHED = 'shed'
+EVENT_STATS = 'stats'
+EVENT_DECISION = 'decision'
+EVENT_METRICS = 'metrics'
+
+ACTION_ACCEPT = 'accept'
+ACTION_REJECT = 'reject'
+
+EDGE_ALLOW = 'allow'
+EDGE_REVOKE = 'revoke'
@@ -38,238 +38,1168 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import json
+import time
+import select
 import serial
 import logging
 import argparse
+import itertools
+import functools
 import threading
+import collections
 import ConfigParser
 
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
 import paho.mqtt.client as paho
 
 from constants import *
+from configutil import get_option
+from spool import SpooledPublisher, load_spool_config
+from metrics import MetricsRegistry, MetricsServer
+from capture import CaptureWriter, DiscardPort, read_capture
+from localipc import LocalServer
+from protocol import (ProtocolError, MAX_FRAME_LENGTH, KeyPress, CardRead, Tamper, PingReply, Watchdog,
+                      COMMAND_ACCEPT, COMMAND_REJECT, TOPIC_SYSTEM, TOPIC_EDGE, TOPIC_METRICS, command_frame, decode_frame, decode_action,
+                      encode_keypress, encode_cardread, encode_tamper, encode_watchdog, encode_decision)
+
+
+class IOBoardConfig(object):
+    def __init__(self, name, serial_url, serial_speed, zones):
+        super(IOBoardConfig, self).__init__()
+        self.name = name
+        self.serial_url = serial_url
+        self.serial_speed = serial_speed
+        # None means every zone no other board claims
+        self.zones = zones
 
 
 class EnterpriseDriverConfig(object):
-    def __init__(self, serial_url, serial_speed, mqtt_host, mqtt_port):
+    def __init__(self, serial_url, serial_speed, mqtt_host, mqtt_port, boards=None,
+                 edge_cache_size=0, edge_cache_file=None,
+                 decision_mode=DECISION_FIRST_ANSWER, decision_plugins=1,
+                 decision_deadline=5.0, decision_default_action=ACTION_REJECT,
+                 debounce_window=1.0, debounce_until_decided=False, spool=None,
+                 metrics_address='127.0.0.1', metrics_port=0, capture_file=None, ipc_socket=None):
         super(EnterpriseDriverConfig, self).__init__()
         self.serial_url = serial_url
         self.serial_speed = serial_speed
         self.mqtt_host = mqtt_host
         self.mqtt_port = mqtt_port
+        self.edge_cache_size = edge_cache_size
+        self.edge_cache_file = edge_cache_file
+        self.decision_mode = decision_mode
+        self.decision_plugins = decision_plugins
+        self.decision_deadline = decision_deadline
+        self.decision_default_action = decision_default_action
+        self.debounce_window = debounce_window
+        self.debounce_until_decided = debounce_until_decided
+        self.spool = spool
+        self.metrics_address = metrics_address
+        self.metrics_port = metrics_port
+        self.capture_file = capture_file
+        self.ipc_socket = ipc_socket
+
+        if boards is None:
+            boards = [IOBoardConfig('default', serial_url, serial_speed, None)]
+        self.boards = boards
+
+
+class EdgeCache(object):
+    '''
+    Cards the driver may open doors for by itself, before any plugin has answered.
+
+    Plugins fill it over enterprised/edge with allow/revoke messages. Every
+    entry remembers the version it was written with, updates older than the
+    entry are ignored, so a late allow cannot undo a revoke. At most size
+    cards are kept, least recently used ones are evicted. With path set the
+    cache is saved to a file and loaded back on start, so known cards keep
+    working after a restart while the broker or the directory is down.
+    '''
+    def __init__(self, size, path):
+        super(EdgeCache, self).__init__()
+        self._size = size
+        self._path = path
+        self._lock = threading.Lock()
+        # card -> (zones, expires, version), revoked cards are kept with no zones
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, msg):
+        '''
+        Raises ValueError, KeyError or TypeError for a malformed message, the cache is then left as it was.
+        '''
+        card = str(msg['card'])
+        version = int(msg['version'])
+        op = msg['op']
+
+        if op == EDGE_ALLOW:
+            if not isinstance(msg['zones'], list):
+                raise TypeError('zones is not a list')
+
+            zones = frozenset(str(zone) for zone in msg['zones'])
+            expires = float(msg['expires'])
+        elif op == EDGE_REVOKE:
+            zones, expires = frozenset(), 0
+        else:
+            logging.warning('Unknown edge cache operation: \'%s\'', op)
+
+            return
+
+        with self._lock:
+            current = self._entries.get(card)
+
+            if current is not None and current[2] >= version:
+                return
+
+            if op == EDGE_ALLOW and current is not None and current[1] > time.time():
+                zones |= current[0]
+
+            self._entries.pop(card, None)
+            self._entries[card] = (zones, expires, version)
+
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+            self._dirty = True
+
+    def allowed(self, card, zone):
+        card = str(card)
+
+        with self._lock:
+            entry = self._entries.get(card)
+
+            if entry is None:
+                return False
+
+            zones, expires, version = entry
+            if str(zone) not in zones or expires <= time.time():
+                return False
+
+            self._entries[card] = self._entries.pop(card)
+
+            return True
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
 
+        try:
+            with open(self._path, 'r') as f:
+                entries = [(str(card), (frozenset(str(zone) for zone in zones), float(expires), int(version)))
+                           for card, zones, expires, version in json.load(f)]
+        except (IOError, ValueError, TypeError) as e:
+            # valid JSON of the wrong shape is as unusable as a corrupt file
+            logging.warning('Cannot load edge cache from %s: %s', self._path, e)
 
-class EnterpriseDriver(object):
-    PING_TIMEOUT_THRESHOLD = 5
+            return
+
+        self._entries.update(entries)
+
+        logging.info('Loaded %d cards into edge cache', len(self._entries))
+
+    def save(self):
+        if not self._path:
+            return
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            entries = [(card, sorted(zones), expires, version)
+                       for card, (zones, expires, version) in self._entries.items()]
+            self._dirty = False
+
+        try:
+            with open(self._path + '.tmp', 'w') as f:
+                json.dump(entries, f)
+            os.rename(self._path + '.tmp', self._path)
+        except (IOError, OSError) as e:
+            logging.warning('Cannot save edge cache to %s: %s', self._path, e)
+
+            with self._lock:
+                self._dirty = True
+
+
+class PendingDecision(object):
+    '''
+    Card read waiting for (or already given) an accept or reject.
+
+    read_at is when the frame came from the serial port, trace holds the
+    timestamps the runner of the deciding plugin sent with its answer.
+    '''
+    def __init__(self, zone, read_id, read_at=None):
+        super(PendingDecision, self).__init__()
+        self.zone = zone
+        self.read_id = read_id
+        self.started = time.time()
+        self.read_at = read_at if read_at is not None else self.started
+        self.answers = {}
+        self.action = None
+        self.plugin = None
+        self.decided = None
+        self.published = None
+        self.trace = None
+
+    def decide(self, action, plugin, trace=None):
+        self.action = action
+        self.plugin = plugin
+        self.trace = trace
+        self.decided = time.time()
+
+    @property
+    def latency(self):
+        return self.decided - self.started
+
+
+class DecisionTracker(object):
+    '''
+    Decides which plugin answer for a card read is sent to the board.
+
+    mode is one of:
+      first_answer - the first accept or reject wins
+      first_accept - the first accept wins, reject needs all plugins to reject
+      all_agree - accept needs all plugins to accept, the first reject wins
+
+    plugins is the number of plugins expected to answer each read. Reads
+    nobody decided on within deadline seconds get default_action. Answers
+    arriving after the decision are suppressed, so the board gets exactly
+    one command per read. Answers sent more than deadline seconds ago (e.g.
+    replayed from a spool after a broker outage) are dropped.
+    '''
+    # decided reads are remembered this long, to suppress late answers
+    LINGER = 60
+
+    def __init__(self, mode, plugins, deadline, default_action):
+        super(DecisionTracker, self).__init__()
+        self._mode = mode
+        self._plugins = plugins
+        self._deadline = deadline
+        self._default_action = default_action
+
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+
+        self._stats = {
+            'decided': 0,
+            'deadline': 0,
+            'suppressed': 0,
+            'unknown': 0,
+            'expired': 0,
+        }
+
+    def open(self, zone, read_id, read_at=None, action=None, plugin=None):
+        '''
+        Starts tracking a read. With action given, the read is decided right away.
+        '''
+        entry = PendingDecision(zone, read_id, read_at)
+
+        with self._lock:
+            self._pending[(zone, read_id)] = entry
+
+            if action is not None:
+                entry.decide(action, plugin)
+                self._stats['decided'] += 1
+
+        return entry
+
+    def _find(self, zone, read_id):
+        if read_id is not None:
+            return self._pending.get((zone, read_id))
+
+        # plugins not sending read ids answer the oldest read still open in the zone
+        for entry in self._pending.values():
+            if entry.zone == zone and entry.decided is None:
+                return entry
+
+        return None
+
+    def _verdict(self, entry):
+        actions = list(entry.answers.values())
+        accepts = actions.count(ACTION_ACCEPT)
+        rejects = actions.count(ACTION_REJECT)
+
+        if self._mode == DECISION_FIRST_ACCEPT:
+            if accepts:
+                return ACTION_ACCEPT
+            if rejects >= self._plugins:
+                return ACTION_REJECT
+        elif self._mode == DECISION_ALL_AGREE:
+            if rejects:
+                return ACTION_REJECT
+            if accepts >= self._plugins:
+                return ACTION_ACCEPT
+        else:
+            return actions[-1]
+
+        return None
+
+    def answer(self, zone, read_id, plugin, action, trace=None, sent=None):
+        '''
+        Records answer of plugin. Returns the decision when this answer made
+        one and the board should be told, None otherwise.
+        '''
+        with self._lock:
+            if sent is not None and self._deadline > 0 and time.time() - sent > self._deadline:
+                self._stats['expired'] += 1
+
+                return None
+
+            entry = self._find(zone, read_id)
+
+            if entry is None:
+                if read_id is not None:
+                    self._stats['unknown'] += 1
+
+                    return None
+
+                # not a reply to a read (e.g. door opened remotely), passed through as it was
+                entry = PendingDecision(zone, None)
+                entry.decide(action, plugin)
+
+                return entry
+
+            if entry.decided is not None:
+                self._stats['suppressed'] += 1
+
+                return None
+
+            entry.answers[plugin if plugin is not None else len(entry.answers)] = action
+
+            verdict = self._verdict(entry)
+            if verdict is None:
+                return None
+
+            entry.decide(verdict, plugin, trace)
+            self._stats['decided'] += 1
+
+            return entry
+
+    def expire(self):
+        '''
+        Decides reads past their deadline and forgets old ones. Returns the decisions made.
+        '''
+        now = time.time()
+        decisions = []
+
+        with self._lock:
+            for key, entry in list(self._pending.items()):
+                if entry.decided is None and self._deadline > 0 and now - entry.started >= self._deadline:
+                    entry.decide(self._default_action, None)
+                    self._stats['deadline'] += 1
+                    decisions.append(entry)
+
+                if now - entry.started >= DecisionTracker.LINGER:
+                    del self._pending[key]
+
+        return decisions
+
+    def is_pending(self, zone, read_id):
+        with self._lock:
+            entry = self._pending.get((zone, read_id))
+
+            return entry is not None and entry.decided is None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = sum(1 for entry in self._pending.values() if entry.decided is None)
+
+            return stats
+
+
+class ReadDebouncer(object):
+    '''
+    Drops repeated reads of a card held at a reader.
+
+    A card read again in the same zone less than window seconds after it was
+    last published is suppressed. With until_decided set, it is also held
+    back for as long as the decision on its previous read is pending.
+    '''
+    def __init__(self, window, until_decided, decisions):
+        super(ReadDebouncer, self).__init__()
+        self._window = window
+        self._until_decided = until_decided
+        self._decisions = decisions
+
+        self._lock = threading.Lock()
+        self._last = {}  # zone -> (cardcode, published at, read id)
+
+        self._stats = {
+            'published': 0,
+            'suppressed': 0,
+        }
+
+    def suppress(self, zone, cardcode):
+        with self._lock:
+            last = self._last.get(zone)
+
+            if last is None or last[0] != cardcode:
+                return False
+
+            if time.time() - last[1] >= self._window and \
+                    not (self._until_decided and self._decisions.is_pending(zone, last[2])):
+                return False
+
+            self._stats['suppressed'] += 1
+
+            return True
+
+    def published(self, zone, cardcode, read_id):
+        with self._lock:
+            self._last[zone] = (cardcode, time.time(), read_id)
+            self._stats['published'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class IOBoard(object):
+    '''
+    Serial link to one IO board, with its own writer stage and ping state.
+    '''
+    # commands opening or closing the door jump ahead of housekeeping traffic
+    PRIORITY_DOOR = 0
+    PRIORITY_HOUSEKEEPING = 10
+    # a partial line this long is noise, not the start of a frame
+    MAX_PARTIAL_LINE = MAX_FRAME_LENGTH * 4
 
     def __init__(self, config):
-        super(EnterpriseDriver, self).__init__()
+        super(IOBoard, self).__init__()
+        self.name = config.name
+        self.zones = config.zones
         self._config = config
 
-    def _connect_serial(self):
+        self.ping_sent_without_response = 0
+        self.capture = None
+        self._read_buffer = b''
+
+        self._out_queue = Queue.PriorityQueue()
+        self._out_sequence = itertools.count()
+        self._out_lock = threading.Lock()
+        self._out_pending = {}  # message -> callbacks to run once it is written
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'coalesced': 0,
+            'write_latency': {},
+        }
+
+    def connect(self):
         self._ser = serial.serial_for_url(self._config.serial_url, self._config.serial_speed)
 
-    def _send_to_io(self, message):
-        logging.debug('Sending: %s', message)
+    def fileno(self):
+        return self._ser.fileno()
+
+    def set_read_timeout(self, timeout):
+        self._ser.timeout = timeout
+
+    @property
+    def selectable(self):
+        try:
+            self._ser.fileno()
+        except (AttributeError, NotImplementedError, ValueError):
+            return False
+
+        return True
+
+    def send(self, message, priority=PRIORITY_HOUSEKEEPING, on_written=None):
+        '''
+        Queues message for write_loop. A message identical to one still waiting in the queue is dropped.
+
+        on_written is called with the time the message (or the one it was coalesced with) was written.
+        '''
+        with self._out_lock:
+            callbacks = self._out_pending.get(message)
+
+            if callbacks is not None:
+                logging.debug('%s: coalesced: %s', self.name, message)
+
+                if on_written is not None:
+                    callbacks.append(on_written)
+
+                with self._stats_lock:
+                    self._stats['coalesced'] += 1
+
+                return
+
+            self._out_pending[message] = [on_written] if on_written is not None else []
 
-        self._ser.write(message + '\n');
+        self._out_queue.put((priority, next(self._out_sequence), message, time.time()))
 
-    # TODO: replace with functools..
-    def _send_ping(self):
+    def write_loop(self):
+        '''
+        Writer stage: the only place writing to the serial port, so frames never interleave.
+        '''
+        while True:
+            priority, sequence, message, queued = self._out_queue.get()
+
+            with self._out_lock:
+                callbacks = self._out_pending.pop(message, [])
+
+            logging.debug('%s: sending: %s', self.name, message)
+
+            self._ser.write((message + '\n').encode('ascii'))
+
+            written = time.time()
+            for callback in callbacks:
+                try:
+                    callback(written)
+                except Exception:
+                    # the command is out, a failing callback must not stop the commands after it
+                    logging.exception('%s: callback for %s failed', self.name, message)
+
+            latency = written - queued
+            logging.debug('%s: sent %s %.1f ms after it was queued', self.name, message, latency * 1000)
+
+            with self._stats_lock:
+                command = self._stats['write_latency'].setdefault(message[1], {'count': 0, 'total': 0.0, 'max': 0.0})
+                command['count'] += 1
+                command['total'] += latency
+                command['max'] = max(command['max'], latency)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'coalesced': self._stats['coalesced'],
+                'ping_sent_without_response': self.ping_sent_without_response,
+                'write_latency': dict(
+                    (command, {
+                        'count': latency['count'],
+                        'avg': latency['total'] / latency['count'],
+                        'max': latency['max'],
+                    }) for command, latency in self._stats['write_latency'].items()),
+            }
+
+    def send_ping(self):
         PING_PACKET = '*P#'
 
-        self._send_to_io(PING_PACKET)
+        self.send(PING_PACKET)
 
-    def _test_serial(self):
-        PING_REPLY_PACKET = '*P'
+    def test(self):
+        PING_REPLY_PACKET = b'*P'
 
-        self._ser.timeout = 1
+        self.set_read_timeout(1)
 
-        self._send_ping()
+        self.send_ping()
 
         response = self._ser.readline().strip()
 
         if response != PING_REPLY_PACKET:
-            logging.critical('Invalid or no reply from IO board')
+            logging.critical('%s: invalid or no reply from IO board', self.name)
 
             exit(0)
 
-        logging.info('IO board has replied to ping, looks like everything is okay')
+        logging.info('%s: IO board has replied to ping, looks like everything is okay', self.name)
+
+    def read_lines(self):
+        '''
+        Reads what the port has buffered and returns the complete lines received so far.
+        '''
+        data = self._ser.read(self._ser.in_waiting or 1)
+
+        if not data:
+            return []
+
+        if self.capture is not None:
+            self.capture.write(self.name, data, time.time())
+
+        return self.frame(data)
+
+    def frame(self, data):
+        '''
+        Returns the lines data completes, keeping a trailing partial line for the next call.
+        '''
+        lines = (self._read_buffer + data).split(b'\n')
+        self._read_buffer = lines.pop()
+
+        if len(self._read_buffer) > IOBoard.MAX_PARTIAL_LINE:
+            # no frame is that long, it is line noise and would only grow
+            logging.warning('%s: dropping %d bytes without a newline', self.name, len(self._read_buffer))
+            self._read_buffer = b''
+
+        return [line.strip().decode('ascii', 'replace') for line in lines if line.strip()]
+
+
+class EnterpriseDriver(object):
+    PING_TIMEOUT_THRESHOLD = 5
+    PING_INTERVAL = 5
+    STATS_INTERVAL = 60
+    IO_QUEUE_SIZE = 256
+    DECISION_TICK = 0.1
+    REPLAY_SETTLE = 1.0
+
+    def __init__(self, config):
+        super(EnterpriseDriver, self).__init__()
+        self._config = config
+        self._io_queue = Queue.Queue(EnterpriseDriver.IO_QUEUE_SIZE)
+
+        self._outbox = None
+        self._local = None
+
+        self._edge = None
+        if config.edge_cache_size > 0:
+            self._edge = EdgeCache(config.edge_cache_size, config.edge_cache_file)
+
+        self._decisions = DecisionTracker(config.decision_mode, config.decision_plugins,
+                                          config.decision_deadline, config.decision_default_action)
+        self._debouncer = ReadDebouncer(config.debounce_window, config.debounce_until_decided, self._decisions)
+        self._metrics = MetricsRegistry()
+
+        # unique across restarts, so late answers to reads of a previous run are not mistaken for new ones
+        boot = int(time.time())
+        self._read_ids = ('{0:x}-{1}'.format(boot, i) for i in itertools.count(1))
+
+        self._boards = [IOBoard(board_config) for board_config in config.boards]
+        self._zone_boards = {}
+        self._default_board = self._boards[0]
+
+        for board in self._boards:
+            if board.zones is None:
+                self._default_board = board
+                continue
+
+            for zone in board.zones:
+                self._zone_boards[zone] = board
 
-    def _mqtt_incoming_Accept(self, zone):
+        self._frame_handlers = {
+            KeyPress: self._io_to_mqtt_KeyPress,
+            CardRead: self._io_to_mqtt_CardRead,
+            Tamper: self._io_to_mqtt_Tamper,
+            PingReply: self._io_to_mqtt_PingReply,
+            Watchdog: self._io_to_mqtt_Watchdog,
+        }
+
+        self._action_handlers = {
+            ACTION_ACCEPT: self._mqtt_incoming_Accept,
+            ACTION_REJECT: self._mqtt_incoming_Reject,
+        }
+
+        self._capture = None
+        if config.capture_file:
+            self._capture = CaptureWriter(config.capture_file, [board.name for board in self._boards])
+
+            for board in self._boards:
+                board.capture = self._capture
+
+    def _board_for_zone(self, zone):
+        return self._zone_boards.get(zone, self._default_board)
+
+    def _connect_serial(self):
+        for board in self._boards:
+            board.connect()
+
+    def _test_serial(self):
+        for board in self._boards:
+            board.test()
+
+    def _mqtt_incoming_Accept(self, zone, on_written=None):
         logging.info('Accept: Z: %s', zone)
-        self._ser.write('*A#{0}\n'.format(zone))
+        self._board_for_zone(zone).send(command_frame(COMMAND_ACCEPT, zone), IOBoard.PRIORITY_DOOR, on_written)
 
-    def _mqtt_incoming_Reject(self, zone):
+    def _mqtt_incoming_Reject(self, zone, on_written=None):
         logging.info('Reject: Z: %s', zone)
-        self._ser.write('*R#{0}\n'.format(zone))
+        self._board_for_zone(zone).send(command_frame(COMMAND_REJECT, zone), IOBoard.PRIORITY_DOOR, on_written)
 
-    def _mqtt_incoming(self, client, userdata, message):
-        msg = json.loads(message.payload)
+    def _trace_swipe(self, decision, written):
+        '''
+        Records how long each stage of a swipe took, from the serial read to the command written back.
 
-        zone = int(msg['zone'])
-        action = msg['action']
+        Stages measured in the runner compare its clock with ours, so they
+        are only meaningful with both on one host (or with synced clocks).
+        '''
+        zone = str(decision.zone)
+        plugin = decision.plugin or 'deadline'
 
-        ACTION_MAPPING = {
-            'accept': self._mqtt_incoming_Accept,
-            'reject': self._mqtt_incoming_Reject
-        }
+        self._metrics.observe('swipe_seconds', written - decision.read_at, zone=zone, plugin=plugin)
+        self._metrics.observe('swipe_stage_seconds', written - decision.decided, zone=zone, stage='write')
 
+        trace = decision.trace
+        if trace is None or decision.published is None:
+            return
+
+        stages = (
+            ('driver', decision.read_at, decision.published),
+            ('broker', decision.published, trace['received']),
+            ('queue', trace['received'], trace['started']),
+            ('lookup', trace['started'], trace['published']),
+            ('answer', trace['published'], decision.decided),
+        )
+
+        for stage, start, end in stages:
+            self._metrics.observe('swipe_stage_seconds', max(end - start, 0), zone=zone, stage=stage)
+
+        self._metrics.observe('plugin_lookup_seconds', max(trace['published'] - trace['started'], 0), plugin=plugin)
+
+    def _publish_decision(self, decision):
+        logging.info('Decision: Z: %s R: %s %s by %s in %.3fs', decision.zone, decision.read_id,
+                     decision.action, decision.plugin, decision.latency)
+
+        self._publish(*encode_decision(decision))
+
+    def _send_decision(self, decision):
+        if decision.read_id is not None:
+            self._action_handlers[decision.action](decision.zone, functools.partial(self._trace_swipe, decision))
+            self._publish_decision(decision)
+        else:
+            self._action_handlers[decision.action](decision.zone)
+
+    def _handle_action(self, topic, payload, direct):
         try:
-            ACTION_MAPPING[action](zone)
-        except KeyError:
-            logging.warning('MQTT has requested unknown action type: \'%s\'', action)
+            action = decode_action(topic, payload)
+        except ProtocolError as e:
+            logging.warning('Invalid action message on %s (%s): %s', topic, e, payload)
+
+            return
+
+        if action.direct and not direct and self._local is not None:
+            # copy for observers of an answer that came over the local socket
+            return
+
+        decision = self._decisions.answer(action.zone, action.read_id, action.plugin, action.action, action.trace,
+                                          action.sent)
+
+        if decision is not None:
+            self._send_decision(decision)
+
+    def _mqtt_incoming(self, client, userdata, message):
+        if message.topic == TOPIC_EDGE:
+            if self._edge is not None:
+                try:
+                    self._edge.update(json.loads(message.payload))
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.warning('Invalid edge message (%s): %s', e, message.payload)
+
+            return
+
+        self._handle_action(message.topic, message.payload, False)
+
+    def _local_incoming(self, topic, payload):
+        self._handle_action(topic, payload, True)
+
+    def _deliver(self, topic, payload):
+        '''
+        Publishes an event for the plugins, straight to the ones on the local socket as well.
+        '''
+        if self._local is not None:
+            self._local.send(topic, payload)
+
+        self._publish(topic, payload)
+
+    def _publish(self, topic, payload):
+        if self._outbox is not None:
+            self._outbox.publish(topic, payload)
+        else:
+            self._client.publish(topic, payload)
+
+    def _mqtt_disconnected(self, client, userdata, rc):
+        if self._outbox is not None:
+            self._outbox.disconnected()
 
     def _mqtt_connected(self, client, userdata, flags, rc):
+        if self._outbox is not None:
+            self._outbox.connected()
+
         client.subscribe('enterprised/reader/+')
+        client.subscribe('enterprised/reader/+/action')
+
+        if self._edge is not None:
+            client.subscribe(TOPIC_EDGE)
 
     def _connect_mqtt(self):
         self._client = paho.Client()
         self._client.on_message = self._mqtt_incoming
         self._client.on_connect = self._mqtt_connected
-        self._client.will_set('enterprised/system', json.dumps({
+        self._client.on_disconnect = self._mqtt_disconnected
+        self._client.will_set(TOPIC_SYSTEM, json.dumps({
             'event': EVENT_SHUTDOWN
         }))
-        self._client.connect(self._config.mqtt_host, port=self._config.mqtt_port)
-        self._client.loop_start()
 
-    def _io_to_mqtt_KeyPress(self, message):
-        # zone, keycode
+        if self._config.spool is not None:
+            # events are spooled until the broker is reachable, no need to wait for it
+            self._outbox = SpooledPublisher(self._client, self._config.spool.open('enterprised'))
+            self._client.connect_async(self._config.mqtt_host, port=self._config.mqtt_port)
+        else:
+            self._client.connect(self._config.mqtt_host, port=self._config.mqtt_port)
 
-        zone = int(message[0])
-        keycode = int(message[1])
+        self._client.loop_start()
 
-        logging.info('KeyPress: Z: %s C: %s', zone, keycode)
+    def _io_to_mqtt_KeyPress(self, board, event, read_at):
+        logging.info('KeyPress: Z: %s C: %s', event.zone, event.keycode)
 
-        return ('enterprised/reader/{0}/keypress'.format(zone), json.dumps({
-            'event': EVENT_KEYPRESS,
-            'zone': zone,
-            'keycode': keycode,
-        }))
+        return encode_keypress(event)
+
+    def _io_to_mqtt_CardRead(self, board, event, read_at):
+        zone = event.zone
+        cardcode = event.cardcode
 
-    def _io_to_mqtt_CardRead(self, message):
-        # zone, cardcode
+        if self._debouncer.suppress(zone, cardcode):
+            logging.debug('CardRead: Z: %s C: %s repeated, suppressed', zone, cardcode)
 
-        zone = int(message[0])
-        cardcode = int(message[1])
+            return None
 
         logging.info('CardRead: Z: %s C: %s', zone, cardcode)
 
-        return ('enterprised/reader/{0}/cardread'.format(zone), json.dumps({
-            'event': EVENT_CARDREAD,
-            'zone': zone,
-            'cardcode': cardcode,
-        }))
+        read_id = next(self._read_ids)
+        self._debouncer.published(zone, cardcode, read_id)
 
-    def _io_to_mqtt_Tamper(self, message):
-        # zone
+        # known card: open now, plugins still get the read to audit it
+        edge_accepted = self._edge is not None and self._edge.allowed(cardcode, zone)
+        if edge_accepted:
+            logging.info('Edge accept: Z: %s C: %s', zone, cardcode)
+            decision = self._decisions.open(zone, read_id, read_at, ACTION_ACCEPT, 'edge')
+            board.send(command_frame(COMMAND_ACCEPT, zone), IOBoard.PRIORITY_DOOR,
+                       functools.partial(self._trace_swipe, decision))
 
-        zone = int(message[0])
+            self._publish_decision(decision)
+        else:
+            decision = self._decisions.open(zone, read_id, read_at)
 
-        logging.info('Tamper: Z: %s', zone)
+        decision.published = time.time()
 
-        return ('enterprised/reader/{0}/tamper'.format(zone), json.dumps({
-            'event': EVENT_TAMPER,
-            'zone': zone
-        }))
+        return encode_cardread(event, read_id, edge_accepted)
 
-    def _io_to_mqtt_Watchdog(self, message):
-        logging.warning('IO board has been reseted by watchdog')
+    def _io_to_mqtt_Tamper(self, board, event, read_at):
+        logging.info('Tamper: Z: %s', event.zone)
 
-        return ('enterprised/system', json.dumps({
-            'event': EVENT_WATCHDOG
-        }))
+        return encode_tamper(event)
 
-    def _io_to_mqtt_PingReply(self, message):
-        logging.debug('Ping reply')
+    def _io_to_mqtt_Watchdog(self, board, event, read_at):
+        logging.warning('IO board %s has been reseted by watchdog', board.name)
 
-        self._ping_sent_without_response = 0
+        return encode_watchdog(board.name)
 
-    def _io_to_mqtt(self, message):
-        action = message[0]
+    def _io_to_mqtt_PingReply(self, board, event, read_at):
+        logging.debug('Ping reply from %s', board.name)
 
-        ACTION_MAPPING = {
-            'K': self._io_to_mqtt_KeyPress,
-            'C': self._io_to_mqtt_CardRead,
-            'T': self._io_to_mqtt_Tamper,
-            'P': self._io_to_mqtt_PingReply,
-            'W': self._io_to_mqtt_Watchdog,
-        }
+        board.ping_sent_without_response = 0
 
-        message = message[1:]
+    def _queue_lines(self, board, lines):
+        for line in lines:
+            try:
+                self._io_queue.put_nowait((board, line, time.time()))
+            except Queue.Full:
+                logging.error('IO queue is full, dropping message from %s: %s', board.name, line)
 
-        try:
-            return ACTION_MAPPING[action](message)
-        except KeyError:
-            logging.warning('IO board has sent unknown action type: \'%s\'', action)
+    def _read_board(self, board):
+        # fallback for links select() cannot wait on, e.g. loop://
+        board.set_read_timeout(1)
 
-    def _process_io2mqtt(self):
-        self._ser.timeout = 5
-        self._ping_sent_without_response = 0
+        while True:
+            self._queue_lines(board, board.read_lines())
+
+    def _read_io(self):
+        '''
+        Reader stage: waits on all boards at once and queues framed lines for _process_io2mqtt.
+        '''
+        selectable = []
+
+        for board in self._boards:
+            if board.selectable:
+                board.set_read_timeout(0)
+                selectable.append(board)
+            else:
+                self._start_thread(self._read_board, board)
+
+        if not selectable:
+            return
+
+        while True:
+            readable, _, _ = select.select(selectable, [], [], 1)
+
+            for board in readable:
+                self._queue_lines(board, board.read_lines())
+
+    def _publish_stats(self):
+        self._publish(TOPIC_SYSTEM, json.dumps({
+            'event': EVENT_STATS,
+            'boards': dict((board.name, board.stats()) for board in self._boards),
+            'edge_cards': len(self._edge) if self._edge is not None else None,
+            'decisions': self._decisions.stats(),
+            'debounce': self._debouncer.stats(),
+            'spool': self._outbox.stats() if self._outbox is not None else None,
+            'local_runners': len(self._local) if self._local is not None else None,
+        }))
+
+        self._publish(TOPIC_METRICS, json.dumps({
+            'event': EVENT_METRICS,
+            'histograms': self._metrics.snapshot(),
+        }))
+
+    def _heartbeat(self):
+        last_stats = time.time()
 
         while True:
-            message_from_io = self._ser.readline().strip()
+            time.sleep(EnterpriseDriver.PING_INTERVAL)
 
-            if len(message_from_io) == 0:
-                self._send_ping()
+            if time.time() - last_stats >= EnterpriseDriver.STATS_INTERVAL:
+                self._publish_stats()
+                last_stats = time.time()
 
-                self._ping_sent_without_response += 1
+            if self._edge is not None:
+                self._edge.save()
 
-                if self._ping_sent_without_response > EnterpriseDriver.PING_TIMEOUT_THRESHOLD:
-                    logging.warning('Ping timeout')
-                    self._client.publish('enterprised/system', json.dumps({
-                        'event': EVENT_TIMEOUT
+            for board in self._boards:
+                board.send_ping()
+
+                board.ping_sent_without_response += 1
+
+                if board.ping_sent_without_response > EnterpriseDriver.PING_TIMEOUT_THRESHOLD:
+                    logging.warning('Ping timeout on %s', board.name)
+                    self._deliver(TOPIC_SYSTEM, json.dumps({
+                        'event': EVENT_TIMEOUT,
+                        'board': board.name,
                     }))
 
-                continue
+    def _expire_decisions(self):
+        while True:
+            time.sleep(EnterpriseDriver.DECISION_TICK)
 
-            logging.debug('Received: %s', message_from_io)
+            for decision in self._decisions.expire():
+                logging.warning('No decision for read %s in zone %s, sending %s',
+                                decision.read_id, decision.zone, decision.action)
 
-            if message_from_io[0] != '*':
-                logging.warning('Invalid message from IO board')
+                self._send_decision(decision)
 
-                continue
+    def _run_stage(self, target, *args):
+        try:
+            target(*args)
+        except Exception:
+            # e.g. a board unplugged; a driver that stays up without its reader or writer is deaf to every door
+            logging.exception('%s failed, exiting so that the driver is restarted', target.__name__)
+
+            if self._capture is not None:
+                self._capture.close()
+
+            os._exit(1)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=self._run_stage, args=(target,) + args)
+        thread.daemon = True
+        thread.start()
 
-            message_from_io = message_from_io[1:].split('#')
+    def _process_io2mqtt(self):
+        '''
+        Publisher stage: parses messages framed by _read_io and publishes them.
+        '''
+        while True:
+            board, message_from_io, read_at = self._io_queue.get()
 
-            to_mqtt = self._io_to_mqtt(message_from_io)
+            logging.debug('Received from %s: %s', board.name, message_from_io)
+
+            try:
+                event = decode_frame(message_from_io)
+            except ProtocolError as e:
+                logging.warning('Invalid message from IO board %s (%s): %s', board.name, e, message_from_io)
+
+                continue
+
+            to_mqtt = self._frame_handlers[type(event)](board, event, read_at)
 
             if to_mqtt is None:
                 continue
 
-            self._client.publish(*to_mqtt)
+            self._deliver(*to_mqtt)
 
     def run(self):
         self._connect_serial()
+        for board in self._boards:
+            self._start_thread(board.write_loop)
         self._test_serial()
 
         self._connect_mqtt()
+        self._start_local()
+
+        self._start_thread(self._read_io)
+        self._start_thread(self._heartbeat)
+        self._start_thread(self._expire_decisions)
+
+        if self._config.metrics_port:
+            MetricsServer(self._metrics, self._config.metrics_address, self._config.metrics_port)
 
         self._process_io2mqtt()
 
+    def _start_local(self):
+        if self._config.ipc_socket:
+            self._local = LocalServer(self._config.ipc_socket, self._local_incoming)
+
+    def _feed_capture(self, path, speed):
+        boards = dict((board.name, board) for board in self._boards)
+        first = None
+        started = time.time()
+        lines = 0
+
+        for read_at, name, data in read_capture(path):
+            board = boards.get(name)
+            if board is None:
+                logging.warning('Capture has data of unknown board %s, skipping it', name)
+                continue
+
+            if speed > 0:
+                if first is None:
+                    first = read_at
+
+                delay = started + (read_at - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            for line in board.frame(data):
+                # blocking, a replay as fast as possible must not drop lines
+                self._io_queue.put((board, line, time.time()))
+                lines += 1
+
+        return lines, time.time() - started
+
+    def replay(self, path, speed):
+        '''
+        Feeds a capture through _process_io2mqtt instead of the serial ports and returns a report.
+
+        speed 1 keeps the original timing, 10 is ten times faster, 0 as fast as possible.
+        What the driver sends to the boards is discarded. The local socket is
+        never opened, config should also come from replay_config().
+        '''
+        for board in self._boards:
+            board._ser = DiscardPort()
+            self._start_thread(board.write_loop)
+
+        self._connect_mqtt()
+
+        self._start_thread(self._expire_decisions)
+        self._start_thread(self._process_io2mqtt)
+
+        lines, elapsed = self._feed_capture(path, speed)
+
+        # let the last reads get their decisions, or run into the deadline
+        while not self._io_queue.empty() or self._decisions.stats()['pending']:
+            time.sleep(EnterpriseDriver.DECISION_TICK)
+        time.sleep(EnterpriseDriver.REPLAY_SETTLE)
+
+        return {
+            'lines': lines,
+            'elapsed': elapsed,
+            'decisions': self._decisions.stats(),
+            'debounce': self._debouncer.stats(),
+            'histograms': self._metrics.snapshot(),
+        }
+
+
+def replay_config(config, mqtt_host, mqtt_port):
+    '''
+    Returns config for a replay, which must leave a driver running on the same host alone:
+    no spool, local socket, edge cache file, metrics port or capture, and its own broker.
+    '''
+    config.mqtt_host = mqtt_host
+    config.mqtt_port = mqtt_port
+    config.spool = None
+    config.ipc_socket = None
+    config.edge_cache_file = None
+    config.metrics_port = 0
+    config.capture_file = None
+
+    return config
+
+
+def load_boards(config_file):
+    '''
+    Reads [board:NAME] sections. Without any, [connection] describes the only board.
+
+    [board:staircase]
+    serial_port=/dev/ttyUSB0
+    speed=19200
+    zones=1, 2
+    '''
+    boards = []
+
+    for section in config_file.sections():
+        if not section.startswith(CONFIG_SECTION_BOARD_PREFIX):
+            continue
+
+        zones = None
+        if config_file.has_option(section, CONFIG_BOARD_ZONES):
+            zones = [int(zone) for zone in config_file.get(section, CONFIG_BOARD_ZONES).split(',') if zone.strip()]
+
+        boards.append(IOBoardConfig(
+            section[len(CONFIG_SECTION_BOARD_PREFIX):],
+            config_file.get(section, CONFIG_SERIAL_PORT),
+            config_file.getint(section, CONFIG_SERIAL_SPEED),
+            zones))
+
+    return boards or None
+
 
 def main():
     parser = argparse.ArgumentParser(
         description='Enterprise RFID Unique (EM4100) Access Controller Driver - MQTT<->IOboard link')
     parser.add_argument('--log', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
                         help='log level')
+    parser.add_argument('--capture', metavar='FILE', help='record everything read from the IO boards to FILE')
+    parser.add_argument('--replay', metavar='FILE', help='feed a capture through the driver instead of the IO boards')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='1 keeps the original timing of the capture, 0 replays it as fast as possible')
+    parser.add_argument('--replay-broker', metavar='HOST[:PORT]',
+                        help='MQTT broker of the replay, never the one of the live driver')
+    parser.add_argument('--config', metavar='FILE', action='append',
+                        help='read FILE instead of config.ini and localconfig.ini, can be given more than once')
     args = parser.parse_args()
 
+    if args.replay and not args.replay_broker:
+        parser.error('--replay needs --replay-broker, replayed card reads must not reach the live plugins')
+
     numeric_level = getattr(logging, args.log.upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
     logging.basicConfig(level=numeric_level)
 
     config_file = ConfigParser.RawConfigParser()
-    config_file.read(['config.ini', 'localconfig.ini'])
+    config_file.read(args.config or ['config.ini', 'localconfig.ini'])
+
+    # [connection] is only needed, and only read, without [board:NAME] sections
+    boards = load_boards(config_file)
+    serial_url = serial_speed = None
+    if boards is None:
+        serial_url = config_file.get(CONFIG_SECTION_SERIAL, CONFIG_SERIAL_PORT)
+        serial_speed = config_file.getint(CONFIG_SECTION_SERIAL, CONFIG_SERIAL_SPEED)
 
     config = EnterpriseDriverConfig(
-        serial_url=config_file.get(CONFIG_SECTION_SERIAL, CONFIG_SERIAL_PORT),
-        serial_speed=config_file.getint(CONFIG_SECTION_SERIAL, CONFIG_SERIAL_SPEED),
+        serial_url=serial_url,
+        serial_speed=serial_speed,
         mqtt_host=config_file.get(CONFIG_SECTION_MQTT, CONFIG_MQTT_HOST),
-        mqtt_port=config_file.getint(CONFIG_SECTION_MQTT, CONFIG_MQTT_PORT))
+        mqtt_port=config_file.getint(CONFIG_SECTION_MQTT, CONFIG_MQTT_PORT),
+        boards=boards,
+        edge_cache_size=get_option(config_file, CONFIG_SECTION_EDGE, CONFIG_EDGE_CACHE_SIZE, 0),
+        edge_cache_file=get_option(config_file, CONFIG_SECTION_EDGE, CONFIG_EDGE_CACHE_FILE, None),
+        decision_mode=get_option(config_file, CONFIG_SECTION_DECISION, CONFIG_DECISION_MODE, DECISION_FIRST_ANSWER),
+        decision_plugins=get_option(config_file, CONFIG_SECTION_DECISION, CONFIG_DECISION_PLUGINS, 1),
+        decision_deadline=get_option(config_file, CONFIG_SECTION_DECISION, CONFIG_DECISION_DEADLINE, 5.0),
+        decision_default_action=get_option(config_file, CONFIG_SECTION_DECISION,
+                                           CONFIG_DECISION_DEFAULT_ACTION, ACTION_REJECT),
+        debounce_window=get_option(config_file, CONFIG_SECTION_DEBOUNCE, CONFIG_DEBOUNCE_WINDOW, 1.0),
+        debounce_until_decided=get_option(config_file, CONFIG_SECTION_DEBOUNCE, CONFIG_DEBOUNCE_UNTIL_DECIDED, False),
+        spool=load_spool_config(config_file),
+        metrics_address=get_option(config_file, CONFIG_SECTION_METRICS, CONFIG_METRICS_ADDRESS, '127.0.0.1'),
+        metrics_port=get_option(config_file, CONFIG_SECTION_METRICS, CONFIG_METRICS_PORT, 0),
+        capture_file=args.capture,
+        ipc_socket=get_option(config_file, CONFIG_SECTION_IPC, CONFIG_IPC_SOCKET, '') or None)
+
+    if args.replay:
+        host, _, port = args.replay_broker.partition(':')
+        config = replay_config(config, host, int(port or 1883))
 
     enterprise_driver = EnterpriseDriver(config=config)
-    enterprise_driver.run()
+
+    if args.replay:
+        print(json.dumps(enterprise_driver.replay(args.replay, args.replay_speed), indent=2, sort_keys=True))
+    else:
+        enterprise_driver.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Access history: records events from MQTT into SQLite, one file per month.
+
+    python history.py record
+    python history.py query --zone 3 --since 2016-10-11 --until 2016-10-12
+    python history.py query --uid wbielak --limit 20
+    python history.py export --since 2016-01-01 --format csv > 2016.csv
+    python history.py compact --retention 24
+'''
+
+import os
+import csv
+import sys
+import json
+import time
+import glob
+import sqlite3
+import logging
+import argparse
+import datetime
+import threading
+import collections
+
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+import paho.mqtt.client as paho
+
+from constants import *
+from configutil import get_option
+from auth_plugin import MQTTConfig
+
+COLUMNS = ['ts', 'zone', 'event', 'card', 'uid', 'action', 'plugin', 'read_id', 'latency']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    ts REAL NOT NULL,
+    zone TEXT,
+    event TEXT NOT NULL,
+    card TEXT,
+    uid TEXT,
+    action TEXT,
+    plugin TEXT,
+    read_id TEXT,
+    latency REAL
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS events_card ON events (card, ts);
+CREATE INDEX IF NOT EXISTS events_uid ON events (uid, ts);
+CREATE INDEX IF NOT EXISTS events_zone ON events (zone, ts);
+'''
+
+# events worth keeping, per MQTT event type
+RECORDED = (EVENT_CARDREAD, EVENT_ACTION, EVENT_DECISION, EVENT_TAMPER, EVENT_TIMEOUT, EVENT_WATCHDOG)
+
+
+def month_of(ts):
+    return time.strftime('%Y%m', time.localtime(ts))
+
+
+def previous_month(month):
+    year, month = int(month[:4]), int(month[4:])
+
+    return '{0:04d}{1:02d}'.format(year - (month == 1), (month - 2) % 12 + 1)
+
+
+class HistoryStore(object):
+    '''
+    Events partitioned by month into DIRECTORY/history-YYYYMM.sqlite.
+
+    A query only opens the partitions its time range overlaps, and each of
+    them is indexed on time and on card, uid and zone (each followed by time).
+    '''
+    def __init__(self, directory):
+        super(HistoryStore, self).__init__()
+        self._directory = directory
+        self._connections = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, month):
+        return os.path.join(self._directory, 'history-{0}.sqlite'.format(month))
+
+    def months(self):
+        return sorted(os.path.basename(path)[len('history-'):-len('.sqlite')]
+                      for path in glob.glob(os.path.join(self._directory, 'history-*.sqlite')))
+
+    def _connect(self, month, create=False):
+        connection = self._connections.get(month)
+
+        if connection is None:
+            if not create and not os.path.exists(self._path(month)):
+                return None
+
+            connection = sqlite3.connect(self._path(month))
+            if create:
+                connection.executescript(SCHEMA)
+            self._connections[month] = connection
+
+        return connection
+
+    def insert(self, events):
+        '''
+        Stores events, dicts with COLUMNS keys, in one transaction per partition.
+        '''
+        by_month = collections.defaultdict(list)
+        for event in events:
+            by_month[month_of(event['ts'])].append(tuple(event.get(column) for column in COLUMNS))
+
+        for month, rows in by_month.items():
+            connection = self._connect(month, create=True)
+
+            with connection:
+                connection.executemany('INSERT INTO events VALUES ({0})'.format(', '.join('?' * len(COLUMNS))), rows)
+
+    def query(self, since=None, until=None, card=None, uid=None, zone=None, event=None, limit=None):
+        '''
+        Yields matching events as dicts, newest first.
+        '''
+        conditions = []
+        params = []
+
+        for column, value in (('card', card), ('uid', uid), ('zone', zone), ('event', event)):
+            if value is not None:
+                conditions.append('{0} = ?'.format(column))
+                params.append(value)
+
+        if since is not None:
+            conditions.append('ts >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('ts < ?')
+            params.append(until)
+
+        sql = 'SELECT {0} FROM events'.format(', '.join(COLUMNS))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY ts DESC'
+
+        first = month_of(since) if since is not None else None
+        last = month_of(until) if until is not None else None
+
+        for month in reversed(self.months()):
+            if (first is not None and month < first) or (last is not None and month > last):
+                continue
+
+            for row in self._connect(month).execute(sql, params):
+                yield dict(zip(COLUMNS, row))
+
+                if limit is not None:
+                    limit -= 1
+                    if limit <= 0:
+                        return
+
+    def compact(self, retention):
+        '''
+        Drops partitions older than retention months, then vacuums the rest.
+        '''
+        oldest = month_of(time.time())
+        for i in range(retention - 1):
+            oldest = previous_month(oldest)
+
+        for month in self.months():
+            if month < oldest:
+                connection = self._connections.pop(month, None)
+                if connection is not None:
+                    connection.close()
+
+                os.remove(self._path(month))
+                logging.info('Dropped history of %s', month)
+            else:
+                self._connect(month).execute('VACUUM')
+
+
+try:
+    _SCALAR_TYPES = (str, unicode, int, long, float)
+except NameError:
+    _SCALAR_TYPES = (str, int, float)
+
+
+def scalar(value):
+    '''
+    Returns value when SQLite can store it and it can be a dict key, None otherwise.
+    Message fields come from any MQTT client, a list as read id must not stop the recorder.
+    '''
+    return value if isinstance(value, _SCALAR_TYPES) else None
+
+
+class HistoryRecorder(object):
+    '''
+    Subscribes to the driver's and plugins' events and stores them in a HistoryStore.
+
+    Card reads, plugin answers and decisions are tied together by read id,
+    so that decisions are stored with the card and the uid the plugin found.
+    '''
+    READS_KEPT = 1024
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, config, store):
+        super(HistoryRecorder, self).__init__()
+        self._config = config
+        self._store = store
+        self._queue = Queue.Queue()
+        self._reads = collections.OrderedDict()  # read id -> {card, uid}
+
+    def _remember(self, read_id, **fields):
+        if read_id is None:
+            return {}
+
+        read = self._reads.setdefault(read_id, {})
+        read.update((key, value) for key, value in fields.items() if value is not None)
+
+        while len(self._reads) > HistoryRecorder.READS_KEPT:
+            self._reads.popitem(last=False)
+
+        return read
+
+    def _event(self, message):
+        splitted = message.topic.split('/')
+
+        try:
+            msg = json.loads(message.payload)
+        except ValueError:
+            # plugins used to send plain accept/reject
+            msg = {'action': message.payload.decode('ascii', 'replace')}
+
+        if not isinstance(msg, dict):
+            return None
+
+        if splitted[1] == 'system':
+            event_type = msg.get('event')
+            zone = None
+        else:
+            event_type = splitted[3]
+            zone = splitted[2]
+
+        if event_type not in RECORDED:
+            return None
+
+        read_id = scalar(msg.get('read_id'))
+        card = scalar(msg.get('cardcode'))
+        uid = scalar(msg.get('uid')) if event_type == EVENT_ACTION else None
+
+        read = self._remember(read_id, card=str(card) if card is not None else None, uid=uid)
+
+        return {
+            'ts': time.time(),
+            'zone': zone,
+            'event': event_type,
+            'card': read.get('card', card),
+            'uid': read.get('uid', uid),
+            'action': scalar(msg.get('action')),
+            'plugin': scalar(msg.get('plugin', msg.get('board'))),
+            'read_id': read_id,
+            'latency': scalar(msg.get('latency')),
+        }
+
+    def _mqtt_incoming(self, client, userdata, message):
+        try:
+            event = self._event(message)
+        except Exception:
+            # paho would re-raise it out of loop_forever and end the recorder
+            logging.exception('Cannot record message on %s: %s', message.topic, message.payload)
+
+            return
+
+        if event is not None:
+            self._queue.put(event)
+
+    def _mqtt_connected(self, client, userdata, flags, rc):
+        client.subscribe('enterprised/reader/+/+')
+        client.subscribe('enterprised/system')
+
+    def _writer(self):
+        # SQLite connections stay on this thread
+        while True:
+            events = [self._queue.get()]
+
+            while True:
+                try:
+                    events.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                self._store.insert(events)
+            except sqlite3.Error as e:
+                logging.error('Cannot store %d events: %s', len(events), e)
+
+            time.sleep(HistoryRecorder.FLUSH_INTERVAL)
+
+    def run(self):
+        thread = threading.Thread(target=self._writer)
+        thread.daemon = True
+        thread.start()
+
+        client = paho.Client()
+        client.on_message = self._mqtt_incoming
+        client.on_connect = self._mqtt_connected
+        client.connect(self._config.mqtt_host, port=self._config.mqtt_port)
+        client.loop_forever()
+
+
+def parse_time(text):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(datetime.datetime.strptime(text, fmt).timetuple())
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError('invalid time: {0}'.format(text))
+
+
+def format_event(event):
+    return '{0}  {1:>10}  {2:<9} card={3} uid={4} {5} {6}'.format(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['ts'])),
+        event['zone'] or '-', event['event'], event['card'] or '-', event['uid'] or '-',
+        event['action'] or '', event['plugin'] or '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enterprise RFID access history')
+    parser.add_argument('--log', default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+                        help='log level')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('record', help='store events from MQTT')
+
+    for name in ('query', 'export'):
+        command = commands.add_parser(name, help='{0} events'.format(name))
+        command.add_argument('--since', type=parse_time, help='YYYY-MM-DD [HH:MM[:SS]]')
+        command.add_argument('--until', type=parse_time, help='YYYY-MM-DD [HH:MM[:SS]], exclusive')
+        command.add_argument('--card')
+        command.add_argument('--uid')
+        command.add_argument('--zone')
+        command.add_argument('--event', choices=RECORDED)
+        command.add_argument('--limit', type=int, default=50 if name == 'query' else None)
+        command.add_argument('--format', choices=('text', 'csv', 'json'), default='text' if name == 'query' else 'csv')
+
+    compact = commands.add_parser('compact', help='drop old months and vacuum the rest')
+    compact.add_argument('--retention', type=int, help='months to keep')
+
+    args = parser.parse_args()
+
+    numeric_level = getattr(logging, args.log.upper(), None)
+    logging.basicConfig(level=numeric_level)
+
+    config_file = ConfigParser.RawConfigParser()
+    config_file.read(['config.ini', 'localconfig.ini'])
+
+    store = HistoryStore(get_option(config_file, CONFIG_SECTION_HISTORY, CONFIG_HISTORY_DIRECTORY, 'history'))
+
+    if args.command == 'record':
+        HistoryRecorder(MQTTConfig(
+            mqtt_host=config_file.get(CONFIG_SECTION_MQTT, CONFIG_MQTT_HOST),
+            mqtt_port=config_file.getint(CONFIG_SECTION_MQTT, CONFIG_MQTT_PORT)), store).run()
+    elif args.command == 'compact':
+        retention = args.retention
+        if retention is None:
+            retention = get_option(config_file, CONFIG_SECTION_HISTORY, CONFIG_HISTORY_RETENTION, 24)
+
+        store.compact(retention)
+    else:
+        events = store.query(args.since, args.until, args.card, args.uid, args.zone, args.event, args.limit)
+
+        if args.format == 'csv':
+            writer = csv.DictWriter(sys.stdout, COLUMNS)
+            writer.writeheader()
+            writer.writerows(events)
+        elif args.format == 'json':
+            for event in events:
+                print(json.dumps(event))
+        else:
+            for event in events:
+                print(format_event(event))
+
+
+if __name__ == '__main__':
+    main()
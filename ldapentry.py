@@ -20,16 +20,29 @@
 from auth_plugin import EnterpriseAuthPlugin, main
 
 import sys
-import syslog
 import time
+import logging
+import functools
+import threading
+import collections
 import ldap3
 
+from ldap3.core.exceptions import LDAPException, LDAPCommunicationError
+
 try:
     import ConfigParser
 except ImportError:
     import configparser as ConfigParser
 
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
 from constants import *
+from configutil import get_option
+from cache import TTLCache, NegativeCache, BloomFilter, AttemptRate
+from audit import open_audit_log
 
 config_file = ConfigParser.RawConfigParser()
 config_file.read(['ldap.ini'])
@@ -38,6 +51,19 @@ hosturl = config_file.get(CONFIG_SECTION_LDAP, CONFIG_LDAP_URL)
 binddn = config_file.get(CONFIG_SECTION_LDAP, CONFIG_LDAP_BINDDN)
 bindpw = config_file.get(CONFIG_SECTION_LDAP, CONFIG_LDAP_BINDPW)
 search_base = config_file.get(CONFIG_SECTION_LDAP, CONFIG_LDAP_SEARCH_BASE)
+timeout = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_TIMEOUT, 5)
+pool_size = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_POOL_SIZE, 4)
+pool_idle_check = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_POOL_IDLE_CHECK, 30)
+cache_ttl = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_CACHE_TTL, 60)
+cache_grace = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_CACHE_GRACE, 600)
+cache_size = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_CACHE_SIZE, 1024)
+sync_interval = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_SYNC_INTERVAL, 60)
+full_sync_interval = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_FULL_SYNC_INTERVAL, 3600)
+sync_max_age = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_SYNC_MAX_AGE, 900)
+page_size = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_PAGE_SIZE, 500)
+edge_allow = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_EDGE_ALLOW, False)
+negative_ttl = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_NEGATIVE_TTL, 30)
+scan_threshold = get_option(config_file, CONFIG_SECTION_LDAP, CONFIG_LDAP_SCAN_THRESHOLD, 10)
 
 hsowicz_group = 'cn=members,cn=groups,cn=accounts,dc=at,dc=hskrk,dc=pl'
 ryjek_group = 'cn=ryjek,cn=groups,cn=accounts,dc=at,dc=hskrk,dc=pl'
@@ -46,25 +72,44 @@ ryjek_access = [
     'indoor',
     'magazynek'
 ]
+ryjek_sponsor = 'wbielak'
+
+audit = open_audit_log('zamek_auth')
+
+
+def log(txt, **fields):
+    audit.record(txt, **fields)
+
+LDAPUser = collections.namedtuple('LDAPUser', ['uid', 'member_of', 'expiration'])
+
+USER_ATTRIBUTES = [
+    'uid',
+    'memberOf',
+    'membershipExpiration'
+]
+
 
-syslog.openlog("zamek_auth", 0, 128)
+def to_user(entry):
+    if 'membershipExpiration' in entry:
+        expiration = int(entry.membershipExpiration.value)
+    else:
+        expiration = None
+
+    if 'memberOf' in entry:
+        member_of = frozenset(entry.memberOf.values)
+    else:
+        member_of = frozenset()
 
-def log(txt):
-    syslog.syslog(txt.encode("utf-8"))
-    print(txt.encode("utf-8"))
+    return LDAPUser(entry.uid.value, member_of, expiration)
 
 def get_user_by_card(connection, card_number):
     result = connection.search(
         search_base=search_base,
         search_filter="(uniqueCardId=%s)" % (card_number),
-        attributes=[
-            'uid',
-            'memberOf',
-            'membershipExpiration'
-        ]
+        attributes=USER_ATTRIBUTES
     )
     if len(connection.entries) == 1:
-        return connection.entries[0]
+        return to_user(connection.entries[0])
     else:
         return None
 
@@ -72,51 +117,458 @@ def get_user_by_uid(connection, uid):
     result = connection.search(
         search_base=search_base,
         search_filter="(uid=%s)" % (uid),
-        attributes=[
-            'uid',
-            'memberOf',
-            'membershipExpiration'
-        ]
+        attributes=USER_ATTRIBUTES
     )
     if len(connection.entries) == 1:
-        return connection.entries[0]
+        return to_user(connection.entries[0])
     else:
         return None
 
 def unix_epoch_day():
-    return int(time.time()) / (24 * 60 * 60)
+    return int(time.time()) // (24 * 60 * 60)
 
-def check_ryjek(connection):
-    entry = get_user_by_uid(connection, 'wbielak')
-    if entry:
-        return check_hsowicz(entry)
-    else:
+def check_hsowicz(entry):
+    if entry.expiration is None:
         return False
+    return entry.expiration >= unix_epoch_day()
 
-def check_hsowicz(entry):
-    expiration = int(entry.membershipExpiration.value)
-    return expiration >= unix_epoch_day()
 
+class LDAPUnavailable(LDAPException):
+    pass
 
-def check_card(zone, card_number):
-    server = ldap3.Server(hosturl)
-    connection = ldap3.Connection(
-        server, auto_bind=True, client_strategy=ldap3.SYNC,
-        user=binddn, password=bindpw,
-        authentication=ldap3.SIMPLE, check_names=True
-    )
 
-    entry = get_user_by_card(connection, card_number)
+class LDAPConnectionPool(object):
+    '''
+    Keeps bound connections open between card swipes.
+
+    Every lookup gets a connection for its exclusive use, so concurrent lookups
+    never step on each other's connection.entries. Connections idle for longer
+    than idle_check are verified before use; broken ones are dropped and a new
+    one is bound, with exponential backoff while the server is unreachable.
+    '''
+    RECONNECT_DELAY_MIN = 0.5
+    RECONNECT_DELAY_MAX = 30
+
+    def __init__(self, url, user, password, size, idle_check, timeout):
+        super(LDAPConnectionPool, self).__init__()
+        self._server = ldap3.Server(url, connect_timeout=timeout)
+        self._user = user
+        self._password = password
+        self._idle_check = idle_check
+        self._timeout = timeout
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = Queue.LifoQueue()
+
+        self._backoff_lock = threading.Lock()
+        self._reconnect_delay = 0
+        self._next_attempt = 0
+
+    def _connect(self):
+        with self._backoff_lock:
+            if time.time() < self._next_attempt:
+                raise LDAPUnavailable('LDAP server unreachable, retrying in %.1fs' %
+                                      (self._next_attempt - time.time()))
+
+        try:
+            connection = ldap3.Connection(
+                self._server, auto_bind=True, client_strategy=ldap3.SYNC,
+                user=self._user, password=self._password,
+                authentication=ldap3.SIMPLE, check_names=True,
+                receive_timeout=self._timeout
+            )
+        except LDAPException:
+            with self._backoff_lock:
+                self._reconnect_delay = min(max(self._reconnect_delay * 2, LDAPConnectionPool.RECONNECT_DELAY_MIN),
+                                            LDAPConnectionPool.RECONNECT_DELAY_MAX)
+                self._next_attempt = time.time() + self._reconnect_delay
+
+            logging.warning('LDAP bind failed, next attempt in %.1fs', self._reconnect_delay)
+            raise
+
+        with self._backoff_lock:
+            self._reconnect_delay = 0
+            self._next_attempt = 0
+
+        logging.info('LDAP connection bound')
+
+        return connection
+
+    def _is_alive(self, connection):
+        if connection.closed or not connection.bound:
+            return False
+
+        try:
+            connection.search('', '(objectClass=*)', search_scope=ldap3.BASE, attributes=['1.1'])
+        except LDAPException:
+            return False
+
+        return True
+
+    def _discard(self, connection):
+        try:
+            connection.unbind()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        while True:
+            try:
+                connection, last_used = self._idle.get_nowait()
+            except Queue.Empty:
+                return self._connect()
+
+            if time.time() - last_used < self._idle_check or self._is_alive(connection):
+                return connection
+
+            logging.info('Dropping stale LDAP connection')
+            self._discard(connection)
+
+    def _release(self, connection):
+        self._idle.put((connection, time.time()))
+
+    def warm_up(self):
+        self._slots.acquire()
+        try:
+            self._release(self._connect())
+        finally:
+            self._slots.release()
+
+    def run(self, func, *args):
+        '''
+        Calls func(connection, *args) on a pooled connection.
+
+        If the connection turns out to be broken, it is replaced and the call is repeated once.
+        '''
+        self._slots.acquire()
+        try:
+            for attempt in (0, 1):
+                connection = self._acquire()
+                try:
+                    result = func(connection, *args)
+                except LDAPCommunicationError:
+                    self._discard(connection)
+                    if attempt:
+                        raise
+                    logging.warning('LDAP connection lost, reconnecting')
+                    continue
+                except Exception:
+                    # the call failed, not the connection, it can serve the next one
+                    self._release(connection)
+                    raise
+
+                self._release(connection)
+                return result
+        finally:
+            self._slots.release()
+
+
+def decode_values(values):
+    return [value.decode('utf-8') if isinstance(value, bytes) else value for value in values]
+
+
+class DirectoryIndex(object):
+    '''
+    In-memory copy of every user in search_base, indexed by card and by uid.
+
+    A background thread builds it with one paged search and then polls for
+    entries with a newer modifyTimestamp. Deleted entries are only noticed by
+    the periodic full sync, which rebuilds the whole index.
+
+    known_cards is a BloomFilter of every card seen since the last full sync,
+    None until the first sync. It stays meaningful when the index is too old
+    to be trusted for decisions: a card it does not contain was nobody's.
+    '''
+    SYNC_ATTRIBUTES = USER_ATTRIBUTES + ['uniqueCardId', 'modifyTimestamp']
+
+    def __init__(self, pool, interval, full_interval, max_age, page_size):
+        super(DirectoryIndex, self).__init__()
+        self._pool = pool
+        self._interval = interval
+        self._full_interval = full_interval
+        self._max_age = max_age
+        self._page_size = page_size
+
+        self._cards = {}
+        self._users = {}
+        self._dns = {}
+        self._modified = None
+        self.known_cards = None
+
+        self._last_sync = None
+        self._last_full_sync = None
+
+    @property
+    def lag(self):
+        if self._last_sync is None:
+            return None
+
+        return time.time() - self._last_sync
+
+    @property
+    def usable(self):
+        lag = self.lag
+
+        return lag is not None and lag < self._max_age
+
+    def stats(self):
+        return {
+            'cards': len(self._cards),
+            'users': len(self._users),
+            'lag': self.lag,
+            'filter_bytes': self.known_cards.size if self.known_cards is not None else None,
+        }
+
+    def find_card(self, card_number):
+        return self._cards.get(card_number)
+
+    def find_user(self, uid):
+        return self._users.get(uid)
+
+    def _search(self, connection, search_filter):
+        return connection.extend.standard.paged_search(
+            search_base=search_base,
+            search_filter=search_filter,
+            attributes=DirectoryIndex.SYNC_ATTRIBUTES,
+            paged_size=self._page_size,
+            generator=False
+        )
+
+    def _parse(self, response):
+        '''
+        Returns (user, card numbers, modifyTimestamp) of an entry, None for one without uid.
+        Raises ValueError when membershipExpiration is not a number.
+        '''
+        attributes = response['raw_attributes']
+
+        uid = decode_values(attributes.get('uid', []))
+        if not uid:
+            return None
+
+        expiration = decode_values(attributes.get('membershipExpiration', []))
+
+        user = LDAPUser(
+            uid[0],
+            frozenset(decode_values(attributes.get('memberOf', []))),
+            int(expiration[0]) if expiration else None)
+        cards = frozenset(decode_values(attributes.get('uniqueCardId', [])))
+        modified = decode_values(attributes.get('modifyTimestamp', []))
+
+        return user, cards, modified[0] if modified else None
+
+    def _apply(self, cards, users, dns, dn, user, card_numbers):
+        old = dns.get(dn)
+        if old is not None:
+            old_user, old_cards = old
+            users.pop(old_user.uid, None)
+            for card_number in old_cards:
+                cards.pop(card_number, None)
+
+        dns[dn] = (user, card_numbers)
+        users[user.uid] = user
+        for card_number in card_numbers:
+            cards[card_number] = user
+
+    def _sync(self, full):
+        started = time.time()
+
+        rebuild = full or self._modified is None
+
+        if rebuild:
+            search_filter = '(uid=*)'
+            cards, users, dns = {}, {}, {}
+            modified = None
+        else:
+            search_filter = '(&(uid=*)(modifyTimestamp>=%s))' % self._modified
+            cards, users, dns = self._cards, self._users, self._dns
+            modified = self._modified
+
+        responses = self._pool.run(self._search, search_filter)
+
+        changed = 0
+        added_cards = []
+        for response in responses:
+            if response.get('type') != 'searchResEntry':
+                continue
+
+            try:
+                parsed = self._parse(response)
+            except ValueError as e:
+                # one broken entry must not keep every other change out of the index
+                logging.warning('Skipping unparsable LDAP entry %s: %s', response.get('dn'), e)
+                continue
+
+            if parsed is None:
+                continue
+
+            user, card_numbers, entry_modified = parsed
+            self._apply(cards, users, dns, response['dn'], user, card_numbers)
+            added_cards.extend(card_numbers)
+            changed += 1
+
+            if entry_modified is not None and (modified is None or entry_modified > modified):
+                modified = entry_modified
+
+        if rebuild or self.known_cards is None:
+            known_cards = BloomFilter.from_keys(cards)
+        else:
+            known_cards = self.known_cards
+            for card_number in added_cards:
+                known_cards.add(card_number)
+
+        # full sync builds new dicts and swaps them in, lookups never see a half-built index
+        self._cards, self._users, self._dns = cards, users, dns
+        self.known_cards = known_cards
+        self._modified = modified
+        self._last_sync = started
+        if full:
+            self._last_full_sync = started
+
+        logging.info('LDAP index %s sync: %d entries changed, %d cards, %d users, took %.2fs',
+                     'full' if full else 'incremental', changed, len(cards), len(users), time.time() - started)
+
+    def _run(self):
+        while True:
+            full = self._last_full_sync is None or time.time() - self._last_full_sync >= self._full_interval
+
+            try:
+                self._sync(full)
+            except LDAPException as e:
+                logging.warning('LDAP index sync failed (lag %s): %s', self.lag, e)
+            except Exception:
+                # the thread has to survive, a dead one leaves every swipe to plain LDAP lookups
+                logging.exception('LDAP index sync failed (lag %s)', self.lag)
+
+            time.sleep(self._interval)
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+
+PolicyRule = collections.namedtuple('PolicyRule', ['name', 'group', 'zones', 'sponsor', 'expiration'])
+
+ALL_ZONES = '*'
+
+DEFAULT_POLICY = [
+    # members may enter everywhere as long as their membership is paid
+    PolicyRule('members', hsowicz_group, ALL_ZONES, None, True),
+    # ryjek may enter some zones as long as their sponsor's membership is paid
+    PolicyRule('ryjek', ryjek_group, frozenset(ryjek_access), ryjek_sponsor, False),
+]
+
+
+def load_policy(config_file):
+    '''
+    Reads [policy:NAME] sections, falls back to DEFAULT_POLICY when there are none.
+
+    [policy:ryjek]
+    group = cn=ryjek,cn=groups,cn=accounts,dc=at,dc=hskrk,dc=pl
+    zones = outdoor, indoor, magazynek
+    sponsor = wbielak
+    expiration = no
+    '''
+    rules = []
+
+    for section in config_file.sections():
+        if not section.startswith(CONFIG_SECTION_POLICY_PREFIX):
+            continue
+
+        zones = get_option(config_file, section, CONFIG_POLICY_ZONES, ALL_ZONES).strip()
+        if zones != ALL_ZONES:
+            zones = frozenset(zone.strip() for zone in zones.split(',') if zone.strip())
+
+        rules.append(PolicyRule(
+            section[len(CONFIG_SECTION_POLICY_PREFIX):],
+            config_file.get(section, CONFIG_POLICY_GROUP),
+            zones,
+            get_option(config_file, section, CONFIG_POLICY_SPONSOR, '') or None,
+            get_option(config_file, section, CONFIG_POLICY_EXPIRATION, True)))
+
+    return rules or DEFAULT_POLICY
+
+
+class AccessPolicy(object):
+    '''
+    Policy rules compiled into a zone -> rules table.
+
+    A user is let in when any rule for the zone matches one of their groups,
+    their own membership is valid (if the rule requires it) and the rule's
+    sponsor has a valid membership. Sponsor status is looked up once per
+    refresh interval, not on every swipe.
+    '''
+    def __init__(self, rules, refresh_interval):
+        super(AccessPolicy, self).__init__()
+        self._refresh_interval = refresh_interval
+
+        self._any_zone = tuple(rule for rule in rules if rule.zones == ALL_ZONES)
+        self._zones = {}
+        for rule in rules:
+            if rule.zones == ALL_ZONES:
+                continue
+            for zone in rule.zones:
+                self._zones.setdefault(zone, self._any_zone)
+                self._zones[zone] += (rule,)
+
+        self._groups = frozenset(rule.group for rule in rules)
+        self._sponsor_uids = frozenset(rule.sponsor for rule in rules if rule.sponsor)
+        self._sponsors = {}
+        self._sponsors_checked = None
+        self._lock = threading.Lock()
+
+    def refresh(self, find_user):
+        sponsors = {}
+
+        for uid in self._sponsor_uids:
+            entry = find_user(uid)
+            sponsors[uid] = entry is not None and check_hsowicz(entry)
+
+        self._sponsors = sponsors
+        self._sponsors_checked = time.time()
+
+        logging.info('Sponsor status refreshed: %s', sponsors)
+
+    def _sponsor_valid(self, uid, find_user):
+        with self._lock:
+            if self._sponsors_checked is None or time.time() - self._sponsors_checked >= self._refresh_interval:
+                try:
+                    self.refresh(find_user)
+                except LDAPException as e:
+                    if self._sponsors_checked is None:
+                        raise
+
+                    logging.warning('Sponsor refresh failed, keeping previous status: %s', e)
+                    self._sponsors_checked = time.time()
+
+        return self._sponsors.get(uid, False)
+
+    def allowed(self, zone, entry, find_user):
+        if self._groups.isdisjoint(entry.member_of):
+            return False
+
+        for rule in self._zones.get(str(zone), self._any_zone):
+            if rule.group not in entry.member_of:
+                continue
+            if rule.expiration and not check_hsowicz(entry):
+                continue
+            if rule.sponsor and not self._sponsor_valid(rule.sponsor, find_user):
+                continue
+
+            return True
+
+        return False
+
+
+def check_card(zone, card_number, find_card, find_user, policy):
+    entry = find_card(card_number)
 
     name = None
     result = False
 
     if entry:
-        name = entry.uid.value
-        if hsowicz_group in entry.memberOf:
-            result |= check_hsowicz(entry)
-        if ryjek_group in entry.memberOf and zone in ryjek_access:
-            result |= check_ryjek(connection)
+        name = entry.uid
+        result = policy.allowed(zone, entry, find_user)
 
     return name, result
 
@@ -126,18 +578,124 @@ class LDAPAuthPlugin(EnterpriseAuthPlugin):
         super(LDAPAuthPlugin, self).__init__()
         self.name = 'LDAP connector'
 
+        self._pool = LDAPConnectionPool(hosturl, binddn, bindpw, pool_size, pool_idle_check, timeout)
+        try:
+            self._pool.warm_up()
+        except LDAPException as e:
+            log('LDAP not available at startup: %s' % e)
+
+        self._cards = TTLCache(cache_ttl, cache_grace, cache_size)
+        self._users = TTLCache(cache_ttl, cache_grace, cache_size)
+
+        # cards LDAP recently had no user for, and how often each zone sees cards nobody has
+        self._unknown = NegativeCache(negative_ttl, cache_size)
+        self._unknown_attempts = AttemptRate(60)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'lookups': 0,
+            'negative_hits': 0,
+            'filtered': 0,
+        }
+
+        self._policy = AccessPolicy(load_policy(config_file), cache_ttl)
+
+        self._index = None
+        if sync_interval > 0:
+            self._index = DirectoryIndex(self._pool, sync_interval, full_sync_interval, sync_max_age, page_size)
+            self._index.start()
+
+    def _load_card(self, card_number):
+        return self._pool.run(get_user_by_card, card_number)
+
+    def _load_user(self, uid):
+        return self._pool.run(get_user_by_uid, uid)
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self._stats[counter] += 1
+
+    def _find_card(self, card_number, zone=None):
+        if self._index is not None and self._index.usable:
+            entry = self._index.find_card(card_number)
+            if entry is not None:
+                return entry
+
+        known_cards = self._index.known_cards if self._index is not None else None
+        negative = card_number in self._unknown
+
+        if negative or (known_cards is not None and card_number not in known_cards):
+            attempts = self._unknown_attempts.hit(zone)
+
+            if negative:
+                self._count('negative_hits')
+                return None
+
+            if attempts > scan_threshold:
+                # someone is trying cards in this zone, only cards known at the last sync get a lookup
+                self._count('filtered')
+                return None
+
+        # not synced yet, or the card was added after the last sync
+        self._count('lookups')
+        entry = self._cards.get(card_number, self._load_card)
+        if entry is None:
+            self._unknown.add(card_number)
+
+        return entry
+
+    def _find_user(self, uid):
+        if self._index is not None and self._index.usable:
+            entry = self._index.find_user(uid)
+            if entry is not None:
+                return entry
+
+        return self._users.get(uid, self._load_user)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+
+        stats['negative_cached'] = len(self._unknown)
+        stats['unknown_per_minute'] = self._unknown_attempts.rates()
+        stats['index'] = self._index.stats() if self._index is not None else None
+
+        return stats
+
+    def _reject(self, zoneid, cardcode, uid=None):
+        self.reject(zoneid, uid=uid)
+
+        if edge_allow:
+            # whatever the reason, the driver must not keep opening the door for this card on its own
+            self.edge_revoke(cardcode)
+
     def on_cardread(self, zoneid, cardcode):
-        name, result = check_card(zoneid, cardcode)
+        started = time.time()
+
+        try:
+            name, result = check_card(zoneid, cardcode, functools.partial(self._find_card, zone=zoneid),
+                                      self._find_user, self._policy)
+        except LDAPException as e:
+            self._reject(zoneid, cardcode)
+            log('rejected card %s for zone %s, LDAP error: %s' % (cardcode, zoneid, e),
+                zone=zoneid, card=cardcode, decision=ACTION_REJECT, latency=time.time() - started)
+            return
+
         if not name:
-            log('rejected unknown card %s for zone %s' % (cardcode, zoneid))
-            self.reject(zoneid)
+            self._reject(zoneid, cardcode)
+            log('rejected unknown card %s for zone %s' % (cardcode, zoneid),
+                zone=zoneid, card=cardcode, decision=ACTION_REJECT, latency=time.time() - started)
         else:
             if result:
-                log('accepted card %s (%s) for zone %s' % (cardcode, name, zoneid))
-                self.accept(zoneid)
+                self.accept(zoneid, uid=name)
+                log('accepted card %s (%s) for zone %s' % (cardcode, name, zoneid),
+                    zone=zoneid, card=cardcode, uid=name, decision=ACTION_ACCEPT, latency=time.time() - started)
+                if edge_allow:
+                    # membership is checked by day, so a decision holds until the day is over
+                    self.edge_allow(cardcode, [zoneid], (unix_epoch_day() + 1) * 24 * 60 * 60)
             else:
-                log('rejected card %s (%s) for zone %s' % (cardcode, name, zoneid))
-                self.reject(zoneid)
+                self._reject(zoneid, cardcode, uid=name)
+                log('rejected card %s (%s) for zone %s' % (cardcode, name, zoneid),
+                    zone=zoneid, card=cardcode, uid=name, decision=ACTION_REJECT, latency=time.time() - started)
 
 if __name__ == '__main__':
     main(LDAPAuthPlugin)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import errno
+import socket
+import struct
+import logging
+import threading
+
+
+class LocalLink(object):
+    '''
+    (topic, payload) messages over a stream socket, framed by their lengths.
+
+    With send_timeout set, a send the peer does not take within that many
+    seconds closes the link instead of blocking the sender any longer.
+    '''
+    FRAME = struct.Struct('!HI')  # topic length, payload length
+    # first message of the server on a new link, sent once the link gets everything the driver sends
+    HELLO = 'enterprised/local/hello'
+
+    def __init__(self, sock, on_message, send_timeout=None):
+        super(LocalLink, self).__init__()
+        self._sock = sock
+
+        if send_timeout is not None:
+            # only for sends, the read loop keeps blocking until the peer sends or goes away
+            seconds = int(send_timeout)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                            struct.pack('ll', seconds, int((send_timeout - seconds) * 1e6)))
+
+        self._on_message = on_message
+        self._send_lock = threading.Lock()
+        self.closed = False
+
+    def send(self, topic, payload):
+        if not isinstance(topic, bytes):
+            topic = topic.encode('utf-8')
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+
+        try:
+            with self._send_lock:
+                self._sock.sendall(LocalLink.FRAME.pack(len(topic), len(payload)) + topic + payload)
+        except socket.error:
+            self.close()
+
+            return False
+
+        return True
+
+    def _read(self, size):
+        data = b''
+
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+
+        return data
+
+    def read_loop(self):
+        try:
+            while True:
+                topic_length, payload_length = LocalLink.FRAME.unpack(self._read(LocalLink.FRAME.size))
+                topic = self._read(topic_length).decode('utf-8')
+                payload = self._read(payload_length)
+
+                try:
+                    self._on_message(topic, payload)
+                except Exception:
+                    logging.exception('Failed to handle local message on %s', topic)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+
+            try:
+                # wakes up the read loop, if another thread is closing the link
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+            self._sock.close()
+
+
+class LocalServer(object):
+    '''
+    Unix socket the driver listens on for plugin runners on the same host.
+
+    send() goes to every runner connected at the moment; what they send
+    back is passed to on_message(topic, payload) on the connection's thread.
+    A runner that does not take a message within SEND_TIMEOUT is dropped, so
+    a stalled runner cannot hold up the driver. Only the socket's owner and
+    group may connect.
+    '''
+    SEND_TIMEOUT = 0.2
+    MODE = 0o660
+
+    def __init__(self, path, on_message):
+        super(LocalServer, self).__init__()
+        self._path = path
+        self._on_message = on_message
+        self._lock = threading.Lock()
+        self._links = []
+
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        # nobody can connect before listen(), so there is no window with the umask's mode
+        os.chmod(path, LocalServer.MODE)
+        self._sock.listen(8)
+
+        thread = threading.Thread(target=self._accept, name='local-server')
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            sock, _ = self._sock.accept()
+            link = LocalLink(sock, self._on_message, LocalServer.SEND_TIMEOUT)
+
+            with self._lock:
+                # every message sent after the hello goes to this link as well
+                link.send(LocalLink.HELLO, b'')
+                self._links.append(link)
+
+            logging.info('Plugin runner connected to %s', self._path)
+
+            thread = threading.Thread(target=self._serve, args=(link,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, link):
+        link.read_loop()
+
+        with self._lock:
+            self._links.remove(link)
+
+        logging.info('Plugin runner disconnected from %s', self._path)
+
+    def send(self, topic, payload):
+        with self._lock:
+            links = list(self._links)
+
+        for link in links:
+            link.send(topic, payload)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._links)
+
+
+class LocalClient(object):
+    '''
+    Plugin runner's end of a LocalServer, reconnecting in the background.
+
+    It counts as connected only once the server's hello arrived, from then
+    on the link gets every message the driver sends.
+    '''
+    RECONNECT_DELAY_MIN = 0.5
+    RECONNECT_DELAY_MAX = 30
+
+    def __init__(self, path, on_message):
+        super(LocalClient, self).__init__()
+        self._path = path
+        self._on_message = on_message
+        self._link = None
+        self._ready = False
+
+        thread = threading.Thread(target=self._run, name='local-client')
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def connected(self):
+        link = self._link
+
+        return link is not None and not link.closed and self._ready
+
+    def send(self, topic, payload):
+        '''
+        Returns False when there is no connection, the caller then goes through MQTT.
+        '''
+        link = self._link
+
+        return link is not None and not link.closed and self._ready and link.send(topic, payload)
+
+    def _incoming(self, topic, payload):
+        if topic == LocalLink.HELLO:
+            logging.info('Connected to the driver at %s', self._path)
+            self._ready = True
+
+            return
+
+        self._on_message(topic, payload)
+
+    def _run(self):
+        delay = LocalClient.RECONNECT_DELAY_MIN
+
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                sock.connect(self._path)
+            except socket.error as e:
+                sock.close()
+                logging.debug('Driver not reachable at %s: %s', self._path, e)
+
+                time.sleep(delay)
+                delay = min(delay * 2, LocalClient.RECONNECT_DELAY_MAX)
+
+                continue
+
+            delay = LocalClient.RECONNECT_DELAY_MIN
+
+            self._link = LocalLink(sock, self._incoming)
+            self._link.read_loop()
+            self._link = None
+            self._ready = False
+
+            logging.warning('Lost connection to the driver at %s, back to MQTT', self._path)
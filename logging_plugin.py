@@ -17,16 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import syslog
-
 from auth_plugin import EnterpriseAuthPlugin, main
 
-syslog.openlog("zamek_auth", 0, 128)
-
+from audit import open_audit_log
 
-def log(txt):
-    syslog.syslog(txt.encode("utf-8"))
-    print(txt.encode("utf-8"))
+audit = open_audit_log('zamek_auth')
 
 
 class LoggingPlugin(EnterpriseAuthPlugin):
@@ -35,10 +30,10 @@ class LoggingPlugin(EnterpriseAuthPlugin):
         self.name = 'Plugin that log everything to syslog'
 
     def on_action(self, zoneid, action):
-        log('{}: {}'.format(zoneid, action))
+        audit.record('{}: {}'.format(zoneid, action), zone=zoneid, decision=action)
 
     def on_cardread(self, zoneid, cardcode):
-        log('{}: scan: {}'.format(zoneid, cardcode))
+        audit.record('{}: scan: {}'.format(zoneid, cardcode), zone=zoneid, card=cardcode)
 
 
 if __name__ == '__main__':
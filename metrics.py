@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import logging
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# seconds, from a cached edge decision up to a plugin hitting its deadline
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def snapshot(self):
+        '''
+        Returns {'buckets': [[upper bound, cumulative count], ...], 'sum': ..., 'count': ...}.
+        '''
+        buckets = []
+        total = 0
+
+        for bound, count in zip(self._buckets, self._counts):
+            total += count
+            buckets.append([bound, total])
+
+        total += self._counts[-1]
+
+        return {
+            'buckets': buckets,
+            'sum': self._sum,
+            'count': total,
+        }
+
+
+def escape_label(value):
+    if not isinstance(value, str):
+        try:
+            # unicode plugin names on Python 2
+            value = value.encode('utf-8')
+        except AttributeError:
+            value = str(value)
+
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry(object):
+    '''
+    Histograms by name and labels, e.g. observe('swipe_seconds', 0.12, zone='1', plugin='LDAP').
+
+    Label values may come from MQTT messages (plugin names), so at most
+    max_histograms are kept; observations of new ones beyond that are dropped.
+    '''
+    def __init__(self, max_histograms=256):
+        super(MetricsRegistry, self).__init__()
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._max_histograms = max_histograms
+        self.dropped = 0
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                if len(self._histograms) >= self._max_histograms:
+                    if not self.dropped:
+                        logging.warning('%d histograms reached, dropping observations of new ones',
+                                        self._max_histograms)
+                    self.dropped += 1
+
+                    return
+
+                histogram = self._histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return [dict(histogram.snapshot(), name=name, labels=dict(labels))
+                    for (name, labels), histogram in sorted(self._histograms.items())]
+
+    def render(self):
+        '''
+        Returns the histograms in Prometheus text exposition format.
+        '''
+        lines = []
+        last_name = None
+
+        for metric in self.snapshot():
+            name = metric['name']
+            if name != last_name:
+                lines.append('# TYPE {0} histogram'.format(name))
+                last_name = name
+
+            labels = ['{0}="{1}"'.format(key, escape_label(value)) for key, value in sorted(metric['labels'].items())]
+
+            for bound, count in metric['buckets'] + [['+Inf', metric['count']]]:
+                lines.append('{0}_bucket{{{1}}} {2}'.format(name, ','.join(labels + ['le="{0}"'.format(bound)]), count))
+
+            lines.append('{0}_sum{{{1}}} {2}'.format(name, ','.join(labels), metric['sum']))
+            lines.append('{0}_count{{{1}}} {2}'.format(name, ','.join(labels), metric['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    '''
+    Serves registry on http://address:port/metrics from a background thread.
+    '''
+    def __init__(self, registry, address, port):
+        super(MetricsServer, self).__init__()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render()
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('metrics: ' + format, *args)
+
+        self._server = HTTPServer((address, port), Handler)
+
+        thread = threading.Thread(target=self._server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
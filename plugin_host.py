@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Runs several plugins in one process, sharing one MQTT connection:
+
+    python plugin_host.py ldapentry:LDAPAuthPlugin apientry:SkladkiAPIAuthPlugin logging_plugin:LoggingPlugin
+
+Pass --asyncio (Python 3 only) to use the asyncio runtime from async_plugin.py.
+'''
+
+import sys
+import argparse
+
+from auth_plugin import AuthPluginRunner, load_plugin_class, run_plugins
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('plugins', nargs='+', help='plugin classes, e.g. ldapentry:LDAPAuthPlugin')
+    parser.add_argument('--asyncio', action='store_true', help='use asyncio runtime')
+    args, rest = parser.parse_known_args()
+
+    runner_class = AuthPluginRunner
+    if args.asyncio:
+        from async_plugin import AsyncAuthPluginRunner
+        runner_class = AsyncAuthPluginRunner
+
+    sys.argv = [sys.argv[0]] + rest
+    run_plugins([load_plugin_class(spec) for spec in args.plugins], runner_class)
+
+
+if __name__ == '__main__':
+    main()
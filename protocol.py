@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Codec of the IO board protocol and of the driver's MQTT messages, shared by
+enterprised.py and the plugin runners.
+
+    python protocol.py bench --count 100000
+    python protocol.py fuzz --count 100000 --seed 1
+'''
+
+import re
+import json
+import time
+import logging
+import numbers
+import random
+import argparse
+
+from constants import *
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+# IO board -> driver, *TYPE#field#field
+
+class KeyPress(object):
+    __slots__ = ('zone', 'keycode')
+
+    def __init__(self, zone, keycode):
+        self.zone = zone
+        self.keycode = keycode
+
+
+class CardRead(object):
+    __slots__ = ('zone', 'cardcode')
+
+    def __init__(self, zone, cardcode):
+        self.zone = zone
+        self.cardcode = cardcode
+
+
+class Tamper(object):
+    __slots__ = ('zone',)
+
+    def __init__(self, zone):
+        self.zone = zone
+
+
+class PingReply(object):
+    __slots__ = ()
+
+
+class Watchdog(object):
+    __slots__ = ()
+
+
+# frame type -> (event class, number of integer fields)
+FRAME_TYPES = {
+    'K': (KeyPress, 2),
+    'C': (CardRead, 2),
+    'T': (Tamper, 1),
+    'P': (PingReply, 0),
+    'W': (Watchdog, 0),
+}
+
+# the longest valid frame is a card read, anything much longer is line noise
+MAX_FRAME_LENGTH = 64
+
+
+def decode_frame(line):
+    '''
+    Returns the event of a line from an IO board, raises ProtocolError when it is not a valid frame.
+    '''
+    if line[:1] != '*' or len(line) > MAX_FRAME_LENGTH:
+        raise ProtocolError('not a frame')
+
+    fields = line[1:].split('#')
+
+    try:
+        event_class, arity = FRAME_TYPES[fields[0]]
+    except KeyError:
+        raise ProtocolError('unknown frame type {0!r}'.format(fields[0]))
+
+    if len(fields) <= arity:
+        raise ProtocolError('frame has {0} of {1} fields'.format(len(fields) - 1, arity))
+
+    # int() alone would also take signs, blanks and underscores
+    for field in fields[1:arity + 1]:
+        if not field.isdigit():
+            raise ProtocolError('frame has a non-numeric field')
+
+    try:
+        if arity == 2:
+            return event_class(int(fields[1]), int(fields[2]))
+        if arity == 1:
+            return event_class(int(fields[1]))
+    except ValueError:
+        raise ProtocolError('frame has a non-numeric field')
+
+    return event_class()
+
+
+# driver -> IO board
+
+COMMAND_ACCEPT = 'A'
+COMMAND_REJECT = 'R'
+COMMAND_PING = 'P'
+
+ACTION_COMMANDS = {
+    ACTION_ACCEPT: COMMAND_ACCEPT,
+    ACTION_REJECT: COMMAND_REJECT,
+}
+
+_commands = {}
+
+
+def command_frame(command, zone=None):
+    '''
+    Returns e.g. '*A#3' for command_frame(COMMAND_ACCEPT, 3), built once per command and zone.
+    '''
+    key = (command, zone)
+    frame = _commands.get(key)
+
+    if frame is None:
+        frame = '*{0}'.format(command) if zone is None else '*{0}#{1}'.format(command, zone)
+        frame = _commands[key] = frame
+
+    return frame
+
+
+# MQTT topics
+
+TOPIC_SYSTEM = 'enterprised/system'
+TOPIC_EDGE = 'enterprised/edge'
+TOPIC_METRICS = 'enterprised/metrics'
+
+_reader_topics = {}
+
+
+def reader_topic(zone, event=None):
+    '''
+    Returns 'enterprised/reader/ZONE/EVENT' (or 'enterprised/reader/ZONE'), built once per zone and event.
+    '''
+    key = (zone, event)
+    topic = _reader_topics.get(key)
+
+    if topic is None:
+        topic = 'enterprised/reader/{0}'.format(zone)
+        if event is not None:
+            topic += '/' + event
+
+        topic = _reader_topics[key] = topic
+
+    return topic
+
+
+# parsed topics are kept up to this many, topic strings come from the broker and are not trusted
+TOPIC_CACHE_SIZE = 1024
+
+_parsed_topics = {}
+
+
+def parse_topic(topic):
+    '''
+    Returns (zone, event) of a reader topic, event is None for enterprised/reader/ZONE.
+    Zone stays a string, as hooks have always been given it. Any other topic gives (None, None).
+    '''
+    parsed = _parsed_topics.get(topic)
+
+    if parsed is None:
+        splitted = topic.split('/')
+
+        if len(splitted) in (3, 4) and splitted[:2] == ['enterprised', 'reader']:
+            parsed = (splitted[2], splitted[3] if len(splitted) == 4 else None)
+        else:
+            parsed = (None, None)
+
+        if len(_parsed_topics) < TOPIC_CACHE_SIZE:
+            _parsed_topics[topic] = parsed
+
+    return parsed
+
+
+# driver -> plugins
+
+_KEYPRESS = '{{"event": {0}, "zone": %d, "keycode": %d}}'.format(json.dumps(EVENT_KEYPRESS))
+_CARDREAD = '{{"event": {0}, "zone": %d, "cardcode": %d, "read_id": %s, "edge_accepted": %s}}'.format(
+    json.dumps(EVENT_CARDREAD))
+_TAMPER = '{{"event": {0}, "zone": %d}}'.format(json.dumps(EVENT_TAMPER))
+
+# card reads as encode_cardread writes them are picked apart without json.loads, anything else goes through it
+_CARDREAD_PATTERN = (r'\{{"event": {0}, "zone": \d+, "cardcode": (\d+), "read_id": "([\w.-]*)", '
+                     r'"edge_accepted": (?:true|false)\}}\Z').format(json.dumps(EVENT_CARDREAD))
+_CARDREAD_RE = re.compile(_CARDREAD_PATTERN)
+_CARDREAD_BYTES_RE = re.compile(_CARDREAD_PATTERN.encode('ascii'))
+
+
+def encode_keypress(event):
+    return reader_topic(event.zone, EVENT_KEYPRESS), _KEYPRESS % (event.zone, event.keycode)
+
+
+def encode_cardread(event, read_id, edge_accepted):
+    return reader_topic(event.zone, EVENT_CARDREAD), _CARDREAD % (
+        event.zone, event.cardcode, json.dumps(read_id), 'true' if edge_accepted else 'false')
+
+
+def encode_tamper(event):
+    return reader_topic(event.zone, EVENT_TAMPER), _TAMPER % event.zone
+
+
+def encode_watchdog(board):
+    return TOPIC_SYSTEM, json.dumps({
+        'event': EVENT_WATCHDOG,
+        'board': board,
+    })
+
+
+def encode_decision(decision):
+    return reader_topic(decision.zone, EVENT_DECISION), json.dumps({
+        'event': EVENT_DECISION,
+        'zone': decision.zone,
+        'read_id': decision.read_id,
+        'action': decision.action,
+        'plugin': decision.plugin,
+        'answers': len(decision.answers),
+        'latency': decision.latency,
+    })
+
+
+class ReaderEvent(object):
+    '''
+    Message from the driver as the plugin runners see it, decoded once for all plugins.
+
+    value is what the hook is given besides the zone: the code of a key press
+    or a card read, the action of an action message, otherwise the payload.
+    '''
+    __slots__ = ('event', 'zone', 'value', 'read_id', 'received')
+
+    def __init__(self, event, zone, value, read_id, received):
+        self.event = event
+        self.zone = zone
+        self.value = value
+        self.read_id = read_id
+        self.received = received
+
+
+# field of the driver's JSON payload that becomes ReaderEvent.value
+PAYLOAD_FIELDS = {
+    EVENT_KEYPRESS: 'keycode',
+    EVENT_CARDREAD: 'cardcode',
+    EVENT_ACTION: 'action',
+}
+
+SYSTEM_EVENTS = (EVENT_TIMEOUT, EVENT_WATCHDOG)
+
+
+def decode_message(topic, payload, received=None):
+    '''
+    Returns ReaderEvent of a message the plugins subscribe to, None for messages they do not handle.
+    Raises ProtocolError for a malformed system message.
+    '''
+    if received is None:
+        received = time.time()
+
+    if topic == TOPIC_SYSTEM:
+        try:
+            event = json.loads(payload)['event']
+        except (ValueError, KeyError, TypeError):
+            raise ProtocolError('invalid system message')
+
+        if event not in SYSTEM_EVENTS:
+            return None
+
+        return ReaderEvent(event, None, payload, None, received)
+
+    zone, event = parse_topic(topic)
+    if event is None:
+        return None
+
+    field = PAYLOAD_FIELDS.get(event)
+    if field is None:
+        return ReaderEvent(event, zone, payload, None, received)
+
+    if event == EVENT_CARDREAD:
+        if isinstance(payload, bytes):
+            match = _CARDREAD_BYTES_RE.match(payload)
+            if match is not None:
+                return ReaderEvent(event, zone, str(match.group(1).decode('ascii')),
+                                   str(match.group(2).decode('ascii')), received)
+        else:
+            match = _CARDREAD_RE.match(payload)
+            if match is not None:
+                return ReaderEvent(event, zone, match.group(1), match.group(2), received)
+
+    try:
+        msg = json.loads(payload)
+    except ValueError:
+        # plugins used to send plain accept/reject
+        return ReaderEvent(event, zone, payload, None, received)
+
+    if isinstance(msg, dict) and field in msg:
+        # hooks have always been given codes as strings
+        return ReaderEvent(event, zone, str(msg[field]), msg.get('read_id'), received)
+
+    return ReaderEvent(event, zone, payload, None, received)
+
+
+# plugins -> driver
+
+try:
+    _ID_TYPES = (str, unicode, int, long)
+except NameError:
+    _ID_TYPES = (str, int)
+
+
+def _valid_id(value):
+    # read ids and plugin names are dict keys in the driver, so nothing unhashable may get through
+    return value is None or (isinstance(value, _ID_TYPES) and not isinstance(value, bool))
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+# timestamps of a trace, the driver subtracts them from each other
+TRACE_FIELDS = ('received', 'started', 'published')
+
+
+class Action(object):
+    '''
+    direct is set on the MQTT copy of an action the driver already got over the local socket.
+    sent is when the plugin published it, None for plugins that do not say.
+    '''
+    __slots__ = ('zone', 'action', 'read_id', 'plugin', 'trace', 'direct', 'sent')
+
+    def __init__(self, zone, action, read_id=None, plugin=None, trace=None, direct=False, sent=None):
+        self.zone = zone
+        self.action = action
+        self.read_id = read_id
+        self.plugin = plugin
+        self.trace = trace
+        self.direct = direct
+        self.sent = sent
+
+
+def encode_action(zone, action, read_id, plugin, uid, trace=None, direct=False):
+    msg = {
+        'action': action,
+        'read_id': read_id,
+        'plugin': plugin,
+        'uid': uid,
+        # an action spooled through a broker outage must not open a door long after it was asked to
+        'sent': time.time(),
+    }
+
+    if trace is not None:
+        msg['trace'] = trace
+    if direct:
+        msg['direct'] = True
+
+    return reader_topic(zone, EVENT_ACTION), json.dumps(msg)
+
+
+def decode_action(topic, payload):
+    '''
+    Returns Action of a message to the driver, raises ProtocolError when it is malformed.
+
+    Accepted are JSON {zone, action} on enterprised/reader/ZONE and, on
+    enterprised/reader/ZONE/action, either a plain 'accept'/'reject' or
+    JSON {action, read_id, plugin, trace, sent}.
+    '''
+    zone, event = parse_topic(topic)
+
+    try:
+        msg = json.loads(payload)
+    except ValueError:
+        msg = payload.decode('ascii', 'replace') if isinstance(payload, bytes) else payload
+
+    if not isinstance(msg, dict):
+        msg = {'action': msg}
+
+    try:
+        zone = int(msg['zone'] if event is None else zone)
+        action = msg['action']
+    except (KeyError, TypeError, ValueError):
+        raise ProtocolError('invalid action message')
+
+    if action not in (ACTION_ACCEPT, ACTION_REJECT):
+        raise ProtocolError('unknown action {0!r}'.format(action))
+
+    read_id, plugin = msg.get('read_id'), msg.get('plugin')
+    if not _valid_id(read_id) or not _valid_id(plugin):
+        raise ProtocolError('read_id and plugin have to be strings or numbers')
+
+    sent = msg.get('sent')
+    if sent is not None and not _is_number(sent):
+        raise ProtocolError('sent has to be a number')
+
+    trace = msg.get('trace')
+    if trace is not None and not (isinstance(trace, dict) and all(_is_number(trace.get(field))
+                                                                  for field in TRACE_FIELDS)):
+        # only the latency histograms need it, the answer itself is still good
+        trace = None
+
+    return Action(zone, action, read_id, plugin, trace, msg.get('direct') is True, sent)
+
+
+def bench(count):
+    '''
+    Times the codec on both ends of a card read against the ad hoc code it replaced.
+    '''
+    line = '*C#3#1234567'
+
+    class Handlers(object):
+        def keypress(self):
+            pass
+
+        cardread = tamper = ping = watchdog = timeout = action = keypress
+
+    handlers = Handlers()
+
+    def legacy():
+        # as _io_to_mqtt and AuthPluginRunner._route used to: a dispatch dict per message, JSON built from a dict
+        message = line[1:].split('#')
+        {'K': handlers.keypress, 'C': handlers.cardread, 'T': handlers.tamper,
+         'P': handlers.ping, 'W': handlers.watchdog}[message[0]]
+        zone, cardcode = int(message[1]), int(message[2])
+        topic = 'enterprised/reader/{0}/cardread'.format(zone)
+        payload = json.dumps({'event': EVENT_CARDREAD, 'zone': zone, 'cardcode': cardcode,
+                              'read_id': '57f3a2c1-42', 'edge_accepted': False})
+
+        received = time.time()
+        splitted = topic.split('/')
+        {EVENT_KEYPRESS: handlers.keypress, EVENT_CARDREAD: handlers.cardread, EVENT_TAMPER: handlers.tamper,
+         EVENT_TIMEOUT: handlers.timeout, EVENT_WATCHDOG: handlers.watchdog,
+         EVENT_ACTION: handlers.action}[splitted[3]]
+        msg = json.loads(payload)
+
+        return splitted[2:], str(msg['cardcode']), received, msg.get('read_id')
+
+    def codec():
+        topic, payload = encode_cardread(decode_frame(line), '57f3a2c1-42', False)
+        return decode_message(topic, payload)
+
+    for name, func in (('ad hoc', legacy), ('protocol', codec)):
+        started = time.time()
+        for i in range(count):
+            func()
+        elapsed = time.time() - started
+
+        print('{0:10} {1:6.2f} us per card read'.format(name, elapsed / count * 1e6))
+
+
+def _fuzz_driver():
+    '''
+    Returns EnterpriseDriver._handle_action of a driver without boards or broker attached,
+    None where the driver cannot be imported (it needs pyserial and paho).
+    '''
+    try:
+        import enterprised
+    except ImportError:
+        return None
+
+    driver = enterprised.EnterpriseDriver(enterprised.EnterpriseDriverConfig('loop://', 19200, '127.0.0.1', 1883))
+    # commands only pile up in the boards' queues, decisions are not published anywhere
+    driver._publish = lambda topic, payload: None
+    # every invalid message would be logged
+    logging.disable(logging.WARNING)
+
+    return driver
+
+
+def fuzz(count, seed):
+    '''
+    Feeds random and mutated input to the decoders, which may only fail with ProtocolError,
+    and checks that whatever encodes decodes back to the same event. Action messages are
+    also handed to the driver, which must not raise on any of them.
+    '''
+    rnd = random.Random(seed)
+    alphabet = '*#0123456789KCTPWAR-x \t\x00\xff'
+    values = [None, 0, 1, -1, 1.5, True, 'r-1', '', [1], {'a': 1}, 'accept', 2 ** 70]
+
+    driver = _fuzz_driver()
+    if driver is None:
+        print('enterprised cannot be imported, the driver is left out')
+
+    for i in range(count):
+        zone, code = rnd.randint(0, 2 ** 16), rnd.randint(0, 2 ** 40)
+
+        topic, payload = encode_cardread(decode_frame('*C#{0}#{1}'.format(zone, code)), 'r-{0}'.format(i), bool(i % 2))
+        # paho hands over payloads as bytes on Python 3
+        for received in (decode_message(topic, payload), decode_message(topic, payload.encode('ascii'))):
+            assert (received.event, received.zone, received.value, received.read_id) == \
+                (EVENT_CARDREAD, str(zone), str(code), 'r-{0}'.format(i)), i
+
+        received = decode_message(*encode_keypress(decode_frame('*K#{0}#{1}'.format(zone, code % 10))))
+        assert (received.zone, received.value) == (str(zone), str(code % 10)), i
+
+        action = decode_action(*encode_action(zone, ACTION_ACCEPT, 'r-{0}'.format(i), 'fuzz', None))
+        assert (action.zone, action.action, action.read_id) == (zone, ACTION_ACCEPT, 'r-{0}'.format(i)), i
+
+        # the fast path for card reads has to agree with json.loads on whatever it accepts
+        position = rnd.randrange(len(payload))
+        mutated = payload[:position] + rnd.choice(alphabet + '"{}:,e') + payload[position + 1:]
+        received = decode_message(topic, mutated)
+        try:
+            msg = json.loads(mutated)
+        except ValueError:
+            msg = None
+        if isinstance(msg, dict) and 'cardcode' in msg:
+            assert (received.value, received.read_id) == (str(msg['cardcode']), msg.get('read_id')), mutated
+
+        line = ''.join(rnd.choice(alphabet) for j in range(rnd.randint(0, 24)))
+        payload = ''.join(rnd.choice('{}[]":,0123456789 actionzeread_id') for j in range(rnd.randint(0, 40)))
+        topic = rnd.choice(['enterprised/system', 'enterprised/reader/1/cardread', 'enterprised/reader/1/action',
+                            'enterprised/reader/1', 'enterprised/reader', 'enterprised/reader/1/2/3', ''])
+
+        for decode, args in ((decode_frame, (line,)), (decode_message, (topic, payload)),
+                             (decode_action, (topic, payload))):
+            try:
+                decode(*args)
+            except ProtocolError:
+                pass
+
+        if driver is not None:
+            driver._decisions.open(1, 'r-1')
+
+            fields = dict((key, rnd.choice(values))
+                          for key in ('zone', 'action', 'read_id', 'plugin', 'trace', 'direct', 'sent')
+                          if rnd.random() < 0.7)
+            for message in (payload, json.dumps(fields), json.dumps(dict(fields, action=ACTION_ACCEPT))):
+                driver._handle_action(topic, message, bool(i % 2))
+
+    print('{0} rounds passed'.format(count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enterprise RFID protocol codec')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('bench', help='time encoding and decoding of a card read')
+    command.add_argument('--count', type=int, default=100000)
+
+    command = commands.add_parser('fuzz', help='feed random input to the decoders')
+    command.add_argument('--count', type=int, default=100000)
+    command.add_argument('--seed', type=int, default=None)
+
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        bench(args.count)
+    else:
+        fuzz(args.count, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Authorization module software developed for the staircase door access control at Hackerspace Kraków.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import mmap
+import zlib
+import time
+import struct
+import logging
+import threading
+
+import paho.mqtt.client as paho
+
+from constants import *
+from configutil import get_option
+
+
+class SpoolCorrupted(Exception):
+    pass
+
+
+class Spool(object):
+    '''
+    Append-only ring buffer of (topic, payload) records in a memory-mapped file.
+
+    The file is a header followed by size bytes of records. A record is its
+    length, a CRC and the topic and payload separated by a NUL byte. Records
+    never wrap, the space left at the end of the file is skipped instead.
+    Positions in the header only grow, the physical offset is position % size.
+
+    When a new record does not fit, the oldest ones are evicted
+    (SPOOL_EVICT_OLDEST) or the new one is refused (SPOOL_EVICT_NEWEST).
+    Changes are flushed to disk at most every sync_interval seconds.
+    '''
+    MAGIC = b'ESP1'
+    HEADER = struct.Struct('<4sQQQ')  # magic, head, tail, evicted
+    RECORD = struct.Struct('<II')  # length, crc
+    SKIP = 0xffffffff
+
+    def __init__(self, path, size, sync_interval=1.0, evict=SPOOL_EVICT_OLDEST):
+        super(Spool, self).__init__()
+        self._size = size
+        self._sync_interval = sync_interval
+        self._evict = evict
+        self._lock = threading.Lock()
+        self._last_sync = time.time()
+        self._dirty = False
+
+        total = Spool.HEADER.size + size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fresh = os.fstat(fd).st_size != total
+            if fresh:
+                os.ftruncate(fd, total)
+
+            self._map = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+
+        magic, self._head, self._tail, self.evicted = Spool.HEADER.unpack_from(self._map, 0)
+
+        if fresh or magic != Spool.MAGIC:
+            if not fresh:
+                logging.warning('Spool %s has no valid header, starting empty', path)
+
+            self._head = self._tail = self.evicted = 0
+            self._write_header()
+        elif self._tail > self._head:
+            logging.info('Spool %s holds %d bytes of unsent messages', path, self._tail - self._head)
+
+    def __len__(self):
+        with self._lock:
+            return self._tail - self._head
+
+    def _write_header(self):
+        Spool.HEADER.pack_into(self._map, 0, Spool.MAGIC, self._head, self._tail, self.evicted)
+        self._dirty = True
+
+    def _offset(self, position):
+        return Spool.HEADER.size + position % self._size
+
+    def _room_to_end(self, position):
+        return self._size - position % self._size
+
+    def _record_at(self, position):
+        '''
+        Returns (position of the record, position after it, body) of the first record at or after position.
+        '''
+        if self._room_to_end(position) < Spool.RECORD.size:
+            position += self._room_to_end(position)
+
+        length, crc = Spool.RECORD.unpack_from(self._map, self._offset(position))
+
+        if length == Spool.SKIP:
+            position += self._room_to_end(position)
+            length, crc = Spool.RECORD.unpack_from(self._map, self._offset(position))
+
+        start = self._offset(position) + Spool.RECORD.size
+        body = self._map[start:start + length]
+
+        if len(body) != length or zlib.crc32(body) & 0xffffffff != crc:
+            raise SpoolCorrupted(position)
+
+        return position, position + Spool.RECORD.size + length, body
+
+    def _skip_oldest(self):
+        try:
+            self._head = self._record_at(self._head)[1]
+        except SpoolCorrupted:
+            self._head = self._tail
+
+        if self._head == self._tail:
+            # empty, start over at the beginning of the file
+            self._head = self._tail = 0
+
+    def append(self, topic, payload):
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+
+        body = topic.encode('utf-8') + b'\0' + payload
+        needed = Spool.RECORD.size + len(body)
+
+        if needed > self._size:
+            logging.warning('Message for %s does not fit in the spool, dropped', topic)
+
+            return False
+
+        with self._lock:
+            position = self._tail
+            if self._room_to_end(position) < needed:
+                if self._room_to_end(position) >= Spool.RECORD.size:
+                    Spool.RECORD.pack_into(self._map, self._offset(position), Spool.SKIP, 0)
+
+                position += self._room_to_end(position)
+
+            while position + needed - self._head > self._size:
+                if self._evict == SPOOL_EVICT_NEWEST:
+                    self.evicted += 1
+                    self._write_header()
+
+                    return False
+
+                if self._head >= self._tail:
+                    self._head = position
+                    break
+
+                self._skip_oldest()
+                self.evicted += 1
+
+            offset = self._offset(position)
+            Spool.RECORD.pack_into(self._map, offset, len(body), zlib.crc32(body) & 0xffffffff)
+            self._map[offset + Spool.RECORD.size:offset + needed] = body
+
+            self._tail = position + needed
+            self._write_header()
+            self._sync()
+
+        return True
+
+    def peek(self):
+        '''
+        Returns the oldest (topic, payload) or None when the spool is empty.
+        '''
+        with self._lock:
+            if self._head == self._tail:
+                return None
+
+            try:
+                body = self._record_at(self._head)[2]
+            except SpoolCorrupted:
+                logging.error('Spool is corrupted, dropping %d bytes of messages', self._tail - self._head)
+
+                self._head = self._tail = 0
+                self._write_header()
+
+                return None
+
+            topic, _, payload = body.partition(b'\0')
+
+            return topic.decode('utf-8'), payload
+
+    def pop(self):
+        with self._lock:
+            if self._head < self._tail:
+                self._skip_oldest()
+                self._write_header()
+                self._sync()
+
+    def _sync(self):
+        if self._dirty and time.time() - self._last_sync >= self._sync_interval:
+            self._map.flush()
+            self._dirty = False
+            self._last_sync = time.time()
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                self._map.flush()
+                self._dirty = False
+                self._last_sync = time.time()
+
+
+class SpooledPublisher(object):
+    '''
+    Publishes to MQTT, keeping messages in a Spool while the broker is unreachable.
+
+    Once anything is spooled, new messages are spooled behind it so that
+    ordering is kept, and a background thread replays them after reconnect.
+    '''
+    def __init__(self, client, spool):
+        super(SpooledPublisher, self).__init__()
+        self._client = client
+        self._spool = spool
+        self._lock = threading.Lock()
+        self._connected = False
+        self._wakeup = threading.Event()
+
+        self._replayed = 0
+        self._replay_rate = 0.0
+
+        thread = threading.Thread(target=self._replay)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, topic, payload):
+        with self._lock:
+            if self._connected and len(self._spool) == 0:
+                if self._client.publish(topic, payload).rc == paho.MQTT_ERR_SUCCESS:
+                    return
+
+                self._connected = False
+
+            self._spool.append(topic, payload)
+
+        if self._connected:
+            self._wakeup.set()
+
+    def connected(self):
+        self._connected = True
+        self._wakeup.set()
+
+    def disconnected(self):
+        self._connected = False
+
+    def _replay(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+
+            started = time.time()
+            replayed = 0
+
+            while self._connected:
+                with self._lock:
+                    message = self._spool.peek()
+
+                    if message is None:
+                        break
+
+                    if self._client.publish(*message).rc != paho.MQTT_ERR_SUCCESS:
+                        self._connected = False
+                        break
+
+                    self._spool.pop()
+                    replayed += 1
+
+            self._spool.sync()
+
+            if replayed:
+                elapsed = time.time() - started
+                logging.info('Replayed %d spooled messages in %.1fs', replayed, elapsed)
+
+                self._replayed += replayed
+                self._replay_rate = replayed / max(elapsed, 0.001)
+
+    def stats(self):
+        return {
+            'backlog_bytes': len(self._spool),
+            'evicted': self._spool.evicted,
+            'replayed': self._replayed,
+            'replay_rate': self._replay_rate,
+        }
+
+
+class SpoolConfig(object):
+    def __init__(self, directory, size, sync_interval, evict):
+        self.directory = directory
+        self.size = size
+        self.sync_interval = sync_interval
+        self.evict = evict
+
+    def open(self, name):
+        '''
+        Returns Spool of process name, e.g. 'enterprised'.
+        '''
+        path = os.path.join(self.directory, '{0}.spool'.format(re.sub(r'[^A-Za-z0-9_.-]+', '_', name)))
+
+        return Spool(path, self.size, self.sync_interval, self.evict)
+
+
+def load_spool_config(config_file):
+    '''
+    Reads [spool] section, returns None when no spool directory is configured.
+    '''
+    directory = get_option(config_file, CONFIG_SECTION_SPOOL, CONFIG_SPOOL_DIRECTORY, '')
+
+    if not directory:
+        return None
+
+    return SpoolConfig(
+        directory=directory,
+        size=get_option(config_file, CONFIG_SECTION_SPOOL, CONFIG_SPOOL_SIZE, 1024 * 1024),
+        sync_interval=get_option(config_file, CONFIG_SECTION_SPOOL, CONFIG_SPOOL_SYNC_INTERVAL, 1.0),
+        evict=get_option(config_file, CONFIG_SECTION_SPOOL, CONFIG_SPOOL_EVICT, SPOOL_EVICT_OLDEST))